@@ -1,11 +1,20 @@
-import spotify, youtube, requests, json, time, copy
+import spotify, youtube, connection, ratelimit, httpcache, jsonstore, metrics, quota, singleflight, requests, json, time, copy, traceback
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
-TMR_DELAY = 5            # How long to wait for after an error 429 is received (too many requests)
-ERR_DELAY = 1            # How long to wait before retrying on an error 5XX
+TMR_DELAY = 5            # How long to wait for after an error 429 is received (too many requests) without a Retry-After header
+ERR_DELAY = 1            # Base delay for the jittered exponential backoff before retrying on an error 5XX
 RETRY_ATTEMPTS = 5       # How many times to retry after an error 5XX before giving up
 DURATION_WARN = 0.2      # Decimal difference between two services duration differences to raise an error
 PAGINATION_PAGES = 20    # How many pages to follow with a paging JSON object
+PAGINATION_THREADS = 4   # How many pages of an offset based paging object are fetched at once
 SPOTIFY_IDS_CHUNKS = 100 # Size of the track id "chunks" that spotify_write_playlists sends
+YOUTUBE_IDS_CHUNKS = 40  # Size of the video id "chunks" that youtube_read_playlist looks up at once
+YOUTUBE_INSERT_THREADS = 4 # How many videos youtube_write_playlist adds to a playlist at once
+SNAPSHOT_FILE = "data/spotify_snapshots.json" # Last read snapshot_id and tracks of each spotify playlist
+
+snapshots = jsonstore.JsonStore(SNAPSHOT_FILE)
 
 # Standardised track object to use throughout the program. Album optional
 class Track:
@@ -96,6 +105,12 @@ class Track:
         }
         return d
 
+# Converts an ISO 8601 duration, as returned by YouTube's contentDetails, into seconds.
+# isodate is only imported the first time a duration is parsed, so nothing that never reads a duration loads it
+def parse_duration(duration):
+    import isodate
+    return isodate.parse_duration(duration).total_seconds()
+
 # Converts a dict into a track object
 def track_from_dict(track_dict):
     title = track_dict['title']
@@ -106,63 +121,203 @@ def track_from_dict(track_dict):
     track.services = services
     return track
 
-# A custom request, that handles API errors and 429: To Many Requests errors by waiting and retrying
-def makeRequest(url, method="get", expectedCode=200, *args, **kwargs):
+# Google APIs report per-user rate limiting as a 403 rather than a 429
+def rate_limited(r):
+    if r.status_code == 429:
+        return True
+    if r.status_code == 403 and "googleapis.com" in r.url:
+        try:
+            reasons = [e['reason'] for e in json.loads(r.content)['error']['errors']]
+        except (ValueError, KeyError, TypeError):
+            return False
+        return "rateLimitExceeded" in reasons or "userRateLimitExceeded" in reasons
+    return False
+
+# A custom request, that handles API errors and 429: To Many Requests errors by waiting and retrying.
+# Identical GETs made by several threads at once are only sent once, and every thread gets the same response.
+# auth is the spotify.token or youtube.token the request is made with. Its access token is added as the authorization
+# header each time the request is sent, so if the token expired mid-job and the request gets a 401, the token is
+# refreshed once (by whichever thread gets there first) and the request is sent again.
+# With retry=False, 5XXs and connection errors are raised straight away instead of being retried. Used for requests
+# that aren't safe to send twice, like playlist inserts, as a request can go through and still fail. 429s and 401s
+# are still sent again, as the API turned those away without doing anything
+def makeRequest(url, method="get", expectedCode=200, *args, auth=None, retry=True, **kwargs):
+    key = flight_key(url, method, expectedCode, auth, kwargs)
+    if key == None:
+        return sendRequest(url, method, expectedCode, auth, retry, **kwargs)
+    return singleflight.group.do(key, lambda: sendRequest(url, method, expectedCode, auth, retry, **kwargs), lambda: metrics.registry.coalesced(method, url))
+
+# Returns what identifies a request for singleflight, or None if the request shouldn't be shared. Only GETs are
+# shared, and only when nothing but headers, params and timeout are given, as anything else could change the response.
+# Requests made with different tokens aren't shared, as the accounts could see different things
+def flight_key(url, method, expectedCode, auth, kwargs):
+    if method.lower() != "get" or not set(kwargs) <= {"headers", "params", "timeout"}:
+        return None
+    token = None if auth == None else auth.access_token
+    return json.dumps([url, expectedCode, token, kwargs.get("params") or {}, kwargs.get("headers") or {}], sort_keys=True, default=str)
+
+# Sends a request for makeRequest. Requests are paced through the shared rate limiter, so every thread backs off
+# together when a host is throttling. GETs to the endpoints in httpcache.ENDPOINT_TTLS are served from the on-disk
+# cache while fresh, and revalidated with a conditional request otherwise
+def sendRequest(url, method="get", expectedCode=200, auth=None, retry=True, **kwargs):
     retries = 0
+    replayed = False
+    cacheKey, cached = cache_lookup(url, method, expectedCode, kwargs)
+    if cached and cached.fresh():
+        return cached.response()
+    if cached:
+        kwargs['headers'] = dict(kwargs.get('headers') or {}, **cached.validators())
     while True:
+        quota.budget.charge(method, url) # Raises youtube.QuotaError rather than going over the daily budget
+        ratelimit.limiter.wait(url)
+        if auth != None:
+            sent = auth.token # Refreshed first if it's about to expire
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, authorization="Bearer " + sent)
         try:
-            r = requests.request(method, url, **kwargs)
+            r = connection.request(method, url, **kwargs)
         except requests.exceptions.ConnectionError as e:
             retries += 1
-            if retries >= RETRY_ATTEMPTS:
+            if not retry or retries >= RETRY_ATTEMPTS:
                 raise e
-            time.sleep(ERR_DELAY)
+            metrics.registry.retry(method, url)
+            time.sleep(ratelimit.backoff(retries, ERR_DELAY))
             continue
-        if r.status_code == 429:
-            time.sleep(TMR_DELAY)
+        result = outcome(r, expectedCode, cached, auth, replayed)
+        if result == "throttled":
+            metrics.registry.throttle(method, url)
+            ratelimit.limiter.throttled(url, r, TMR_DELAY)
             continue
-        elif r.status_code == expectedCode:
+        elif result == "ok":
+            ratelimit.limiter.succeeded(url)
+            if cacheKey:
+                httpcache.cache.put(cacheKey, url, r)
             return r
-        elif str(r.status_code).startswith("5"): # To retry a bit rather than instantly erroring on a HTTP 5XX
+        elif result == "not_modified":
+            ratelimit.limiter.succeeded(url)
+            httpcache.cache.revalidated(cacheKey)
+            return cached.response()
+        elif result == "reauthorize": # Only replayed once, so a revoked token still errors
+            replayed = True
+            metrics.registry.reauthorized(method, url)
+            auth.ensure_fresh(sent)
+            continue
+        elif result == "server_error": # To retry a bit rather than instantly erroring on a HTTP 5XX
+            metrics.registry.server_error(method, url)
             retries+=1
-            if retries >= RETRY_ATTEMPTS:
+            if not retry or retries >= RETRY_ATTEMPTS:
                 break
-            time.sleep(ERR_DELAY)
+            metrics.registry.retry(method, url)
+            time.sleep(ratelimit.backoff(retries, ERR_DELAY))
             continue
         else:
             break
+    raise api_error(url, r, expectedCode)
+
+# Returns the httpcache key of a request and the Entry stored under it, either of which can be None.
+# Only GETs expecting a 200 are cached
+def cache_lookup(url, method, expectedCode, kwargs):
+    if method.lower() != "get" or expectedCode != 200:
+        return None, None
+    cacheKey = httpcache.cache.key(url, kwargs.get("params"))
+    if not cacheKey:
+        return None, None
+    return cacheKey, httpcache.cache.get(cacheKey)
+
+# Sorts a response into what sendRequest does next: "ok", "not_modified" (serve the cached entry), "throttled"
+# (wait and send again), "reauthorize" (refresh the token and send again), "server_error" (retry) or "error"
+def outcome(r, expectedCode, cached, auth, replayed):
+    if rate_limited(r):
+        return "throttled"
+    elif r.status_code == expectedCode:
+        return "ok"
+    elif r.status_code == 304 and cached:
+        return "not_modified"
+    elif r.status_code == 401 and auth != None and not replayed:
+        return "reauthorize"
+    elif str(r.status_code).startswith("5"):
+        return "server_error"
+    else:
+        return "error"
+
+# The exception for a response that wasn't expectedCode
+def api_error(url, r, expectedCode):
     if "spotify.com" in url:
-        raise spotify.ApiError(r.status_code, expectedCode, r.content)
+        return spotify.ApiError(r.status_code, expectedCode, r.content)
     else:
-        raise youtube.ApiError(r.status_code, expectedCode, r.content)
+        return youtube.ApiError(r.status_code, expectedCode, r.content)
 
 # A wrapper around makeRequest that handles pagination. Returns a list of all returned items
-def pagination(url, *args, **kwargs):
-    items = []
-    pageToken = None
-    for page in range(PAGINATION_PAGES):
-        if pageToken: params = {"pageToken":pageToken}
-        else: params = {}
+# Spotify paging objects give the total and limit on the first page, so the rest of the pages are fetched at once.
+# YouTube's nextPageToken can only be known from the previous page, so those are followed one after another.
+# At most pages pages are read, or every page if pages is None
+def pagination(url, *args, pages=PAGINATION_PAGES, **kwargs):
+    r = makeRequest(url, params={}, *args, **kwargs)
+    data = json.loads(r.content)
+    items = data['items']
+    page_urls = offset_urls(data, pages)
+    if page_urls:
+        with ThreadPoolExecutor(max_workers=PAGINATION_THREADS, thread_name_prefix="pagination") as executor:
+            results = executor.map(metrics.carry_job(lambda page_url: json.loads(makeRequest(page_url, *args, **kwargs).content)['items']), page_urls)
+            for page in results: # map returns the pages in order, so the items stay in playlist order
+                items += page
+        return items
+    page = 1
+    while pages == None or page < pages:
+        page += 1
+        following = next_page(url, data)
+        if following == None:
+            break
+        url, params = following
         r = makeRequest(url, params=params, *args, **kwargs)
         data = json.loads(r.content)
         items += data['items']
-        if 'next' in data.keys() and data['next']: # If 'next' exists and is non-None
-            url = data['next']
-        elif 'nextPageToken' in data.keys() and data['nextPageToken']:
-            pageToken = data['nextPageToken']
-        else:
-            break
     return items
 
+# Like pagination, but a generator that yields the items of each page as soon as it arrives.
+# Pages are requested one at a time, only when the previous page has been used, so the first items are available
+# after a single request and only one page is held in memory
+def iter_pagination(url, *args, **kwargs):
+    params = {}
+    for page in range(PAGINATION_PAGES):
+        r = makeRequest(url, params=params, *args, **kwargs)
+        data = json.loads(r.content)
+        yield data['items']
+        following = next_page(url, data)
+        if following == None:
+            break
+        url, params = following
+
+# Returns the url and params of the page after data, or None if data is the last page
+def next_page(url, data):
+    if 'next' in data.keys() and data['next']: # If 'next' exists and is non-None
+        return data['next'], {}
+    elif 'nextPageToken' in data.keys() and data['nextPageToken']:
+        return url, {"pageToken":data['nextPageToken']}
+    else:
+        return None
+
+# Works out the urls of every remaining page from the first page of an offset based paging object.
+# Returns an empty list if there are no more pages or the paging object isn't offset based. pages is as in pagination
+def offset_urls(data, pages=PAGINATION_PAGES):
+    if not data.get('next') or not all(key in data for key in ('total', 'limit', 'offset')):
+        return []
+    url = urlsplit(data['next'])
+    query = dict(parse_qsl(url.query))
+    end = data['total'] if pages == None else min(data['total'], data['offset'] + data['limit'] * pages)
+    urls = []
+    for offset in range(data['offset'] + data['limit'], end, data['limit']):
+        query['offset'] = str(offset)
+        query['limit'] = str(data['limit'])
+        urls.append(urlunsplit(url._replace(query=urlencode(query))))
+    return urls
+
 # Deletes a playlist from spotify
 def spotify_delete_playlist(auth, playlist_id):
-    headers = {"authorization":"Bearer "+auth.token}
-    r = makeRequest("https://api.spotify.com/v1/playlists/"+playlist_id+"/followers", "delete", headers=headers)
+    r = makeRequest("https://api.spotify.com/v1/playlists/"+playlist_id+"/followers", "delete", auth=auth)
 
 # Deletes a plsylist from youtube
 def youtube_delete_playlist(auth, playlist_id):
-    headers = {"authorization":"Bearer "+auth.token}
-    r = makeRequest("https://www.googleapis.com/youtube/v3/playlists?id="+playlist_id, "delete", headers=headers, expectedCode=204)
+    r = makeRequest("https://www.googleapis.com/youtube/v3/playlists?id="+playlist_id, "delete", auth=auth, expectedCode=204)
 
 # Gets an item from spotify, track, album or playlist
 def spotify_get_item(auth, track_id, itemType="track"):
@@ -175,9 +330,8 @@ def spotify_get_item(auth, track_id, itemType="track"):
         itemType = types_dict[itemType]
     except KeyError:
         raise ValueError("Invalid itemType for spotify_get_item - " + itemType)
-    headers = {"authorization":"Bearer "+auth.token}
     try:
-        r = makeRequest("https://api.spotify.com/v1/"+itemType+"/"+track_id, "get", headers=headers)
+        r = makeRequest("https://api.spotify.com/v1/"+itemType+"/"+track_id, "get", auth=auth)
     except spotify.ApiError as e:
         if e.statusCode == 404:
             return None
@@ -197,8 +351,7 @@ def youtube_get_item(auth, video_id, itemType="video"):
     except KeyError:
         raise ValueError("Invalid itemType for youtube_get_item - " + itemType)
 
-    headers = {"authorization": "Bearer " + auth.token}
-    r = makeRequest("https://www.googleapis.com/youtube/v3/videos?part=snippet%2CcontentDetails&id=" + video_id, "get", headers=headers)
+    r = makeRequest("https://www.googleapis.com/youtube/v3/videos?part=snippet%2CcontentDetails&id=" + video_id, "get", auth=auth)
     data = json.loads(r.content)['items']
     if data:
         return data[0]
@@ -206,11 +359,11 @@ def youtube_get_item(auth, video_id, itemType="video"):
         return None
 
 # Reads all loaded spotify playlists
-def spotify_read_playlists(auth, ids=False):
+# If incremental is True, playlists whose snapshot_id hasn't changed since they were last read aren't downloaded again
+def spotify_read_playlists(auth, ids=False, incremental=True):
     playlists = {}
     marked_items = set()
-    headers = {"authorization":"Bearer "+auth.token}
-    items = pagination("https://api.spotify.com/v1/me/playlists", "get", headers=headers)
+    items = pagination("https://api.spotify.com/v1/me/playlists", "get", auth=auth)
     if ids:
         for item in items:
             if item['name'] in playlists.keys():
@@ -222,25 +375,60 @@ def spotify_read_playlists(auth, ids=False):
             marked_id = playlists.pop(marked_name)
             playlists[marked_name + " (" + marked_id + ")"] = marked_id
     else:
-        for item in items:
-            if 'id' in item['tracks']:
-                playlist_id = item['tracks']['id']
-            elif 'href' in item['tracks']:
-                url = item['tracks']['href']
-                playlist_id = url.split("/")[-2]
-            playlists[item['name']] = spotify_read_playlist(auth, playlist_id)
+        changed = {}
+        try:
+            for item in items:
+                if 'id' in item['tracks']:
+                    playlist_id = item['tracks']['id']
+                elif 'href' in item['tracks']:
+                    url = item['tracks']['href']
+                    playlist_id = url.split("/")[-2]
+                if incremental:
+                    playlists[item['name']] = spotify_sync_playlist(auth, playlist_id, item['snapshot_id'], changed)
+                else:
+                    playlists[item['name']] = spotify_read_playlist(auth, playlist_id)
+        finally: # The snapshot file holds every playlist's tracks, so it's written once, even if a read failed part way
+            if changed: snapshots.update(changed)
     return playlists
 
+# Returns the tracks of a spotify playlist, only downloading them if snapshot_id differs from the last time it was read.
+# /me/playlists returns every playlist's snapshot_id, so an unchanged library costs a single paging pass.
+# New snapshots are added to the changed dict if given, for the caller to save together, otherwise saved straight away
+def spotify_sync_playlist(auth, playlist_id, snapshot_id, changed=None):
+    saved = snapshots.get(playlist_id)
+    if saved and saved['snapshot_id'] == snapshot_id:
+        return [track_from_dict(track) for track in copy.deepcopy(saved['tracks'])]
+    tracks = spotify_read_playlist(auth, playlist_id)
+    snapshot = {
+        "snapshot_id": snapshot_id,
+        "tracks": [track.to_dict() for track in tracks]
+    }
+    if changed == None:
+        snapshots.set(playlist_id, snapshot)
+    else:
+        changed[playlist_id] = snapshot
+    return tracks
+
 # Reads a single spotify playlist
 def spotify_read_playlist(auth, playlist_id, album=False):
-    tracks = []
-    headers = {
-        "authorization": "Bearer " + auth.token,
-    }
     if album:
-        items = pagination("https://api.spotify.com/v1/albums/"+playlist_id+"/tracks", "get", headers=headers)
+        items = pagination("https://api.spotify.com/v1/albums/"+playlist_id+"/tracks", "get", auth=auth)
     else:
-        items = pagination("https://api.spotify.com/v1/playlists/" + playlist_id + "/tracks", "get", headers=headers)
+        items = pagination("https://api.spotify.com/v1/playlists/" + playlist_id + "/tracks", "get", auth=auth)
+    return spotify_parse_tracks(items, album)
+
+# Like spotify_read_playlist, but a generator that yields a list of tracks for each page as it arrives
+def spotify_iter_playlist(auth, playlist_id, album=False):
+    if album:
+        url = "https://api.spotify.com/v1/albums/" + playlist_id + "/tracks"
+    else:
+        url = "https://api.spotify.com/v1/playlists/" + playlist_id + "/tracks"
+    for items in iter_pagination(url, "get", auth=auth):
+        yield spotify_parse_tracks(items, album)
+
+# Converts the items of a spotify playlist (or album, if album is True) into track objects
+def spotify_parse_tracks(items, album=False):
+    tracks = []
     for track in items:
         if album:
             track['album'] = {"name":None} # When getting the tracks from an album, the album name itself is not in the track object.
@@ -266,7 +454,6 @@ def spotify_write_playlist(auth, name, desc, tracks, public=True):
         track_id = track.services['spotify']['id']
         if track_id: ids.append("spotify:track:"+track_id)
     headers = {
-        "authorization":"Bearer " + auth.token,
         "content-type":"application/json"
     }
     data = {
@@ -274,17 +461,16 @@ def spotify_write_playlist(auth, name, desc, tracks, public=True):
         "description":desc,
         "public":public
     }
-    r = makeRequest("https://api.spotify.com/v1/users/" + auth.username + "/playlists", "post", 201, json=data, headers=headers)
+    r = makeRequest("https://api.spotify.com/v1/users/" + auth.username + "/playlists", "post", 201, json=data, headers=headers, auth=auth)
     playlist_id = json.loads(r.content)['id']
     data_chunks = [{"uris":ids[i:i + SPOTIFY_IDS_CHUNKS]} for i in range(0, len(ids), SPOTIFY_IDS_CHUNKS)]
     for chunk in data_chunks:
-        r = makeRequest("https://api.spotify.com/v1/users/" + auth.username + "/playlists/" + playlist_id + "/tracks", "post", 201, json=chunk, headers=headers)
+        r = makeRequest("https://api.spotify.com/v1/users/" + auth.username + "/playlists/" + playlist_id + "/tracks", "post", 201, json=chunk, headers=headers, auth=auth)
     return playlist_id
 
 # Updates a spotify playlist
 def spotify_update_playlist(auth, playlist_object, name, desc, public=True):
     headers = {
-        "authorization": "Bearer " + auth.token,
         "content-type": "application/json"
     }
     data = {
@@ -293,17 +479,14 @@ def spotify_update_playlist(auth, playlist_object, name, desc, public=True):
         "public": public
     }
     playlist_id = playlist_object['id']
-    r = makeRequest("https://api.spotify.com/v1/playlists/"+playlist_id, "put", headers=headers, data=data)
+    r = makeRequest("https://api.spotify.com/v1/playlists/"+playlist_id, "put", headers=headers, auth=auth, data=data)
 
 # Gets spotify playlist info
 def spotify_get_playlist_info(auth, playlist_id, album=False):
-    headers = {
-        "authorization": "Bearer " + auth.token,
-    }
     if album:
-        r = makeRequest("https://api.spotify.com/v1/albums/" + playlist_id, "get", headers=headers)
+        r = makeRequest("https://api.spotify.com/v1/albums/" + playlist_id, "get", auth=auth)
     else:
-        r = makeRequest("https://api.spotify.com/v1/playlists/"+playlist_id, "get", headers=headers)
+        r = makeRequest("https://api.spotify.com/v1/playlists/"+playlist_id, "get", auth=auth)
     data = json.loads(r.content)
     return data
 
@@ -313,9 +496,6 @@ def youtube_update_playlist(auth, playlist_object, name, desc, public=True):
         privacy = "public"
     else:
         privacy = "unlisted"
-    headers = {
-        "authorization": "Bearer " + auth.token,
-    }
     data = copy.deepcopy(playlist_object)
     data['snippet']['title'] = name
     data['snippet']['description'] = desc
@@ -327,33 +507,36 @@ def youtube_update_playlist(auth, playlist_object, name, desc, public=True):
         data.pop('status')
     else:
         part = "snippet%2Cstatus"
-    r = makeRequest("https://www.googleapis.com/youtube/v3/playlists?part="+part, "put", headers=headers, json=data)
+    r = makeRequest("https://www.googleapis.com/youtube/v3/playlists?part="+part, "put", auth=auth, json=data)
 
 # Gets info from a youtube playlist
 def youtube_get_playlist_info(auth, playlist_id):
-    headers = {
-        "authorization": "Bearer " + auth.token,
-    }
-    r = makeRequest("https://www.googleapis.com/youtube/v3/playlists?part=snippet%2CcontentDetails%2Cstatus&id="+playlist_id, "get", headers=headers)
+    r = makeRequest("https://www.googleapis.com/youtube/v3/playlists?part=snippet%2CcontentDetails%2Cstatus&id="+playlist_id, "get", auth=auth)
     data = json.loads(r.content)
     return data['items'][0]
 
 # Creates a youtube playlist
 def youtube_write_playlist(auth, name, desc, tracks, public=True):
-    if public:
-        privacy = "public"
-    else:
-        privacy = "unlisted"
     ids = []
     for track in tracks:
         track_id = track.services['youtube']['id']
         if track_id: ids.append(track_id)
     headers = {
-        "authorization": "Bearer " + auth.token,
         'accept': 'application/json',
         'content-type': 'application/json'
     }
-    data = {
+    r = makeRequest("https://www.googleapis.com/youtube/v3/playlists?part=snippet%2Cstatus", "post", 200, headers=headers, auth=auth, json=youtube_playlist_data(name, desc, public))
+    playlist_id = json.loads(r.content)['id']
+    youtube_insert_videos(auth, playlist_id, ids)
+    return playlist_id
+
+# The body of the request that creates a youtube playlist
+def youtube_playlist_data(name, desc, public=True):
+    if public:
+        privacy = "public"
+    else:
+        privacy = "unlisted"
+    return {
         "kind": "youtube#playlist",
         "snippet": {
             "title": name,
@@ -363,30 +546,117 @@ def youtube_write_playlist(auth, name, desc, tracks, public=True):
             "privacyStatus": privacy
         },
     }
-    r = makeRequest("https://www.googleapis.com/youtube/v3/playlists?part=snippet%2Cstatus", "post", 200, headers=headers, json=data)
-    playlist_id = json.loads(r.content)['id']
-    for video in ids:
-        data = {
-            "kind": "youtube#playlistItem",
+
+# Adds a list of video ids to a youtube playlist, keeping their order.
+# Up to YOUTUBE_INSERT_THREADS inserts are in flight at once, each asking for its final position with snippet.position.
+# Afterwards the playlist is read back (1 quota unit per 50 items): positions that errored are retried one at a time
+# unless the video turns out to be there anyway, so nothing is added twice, and anything that landed out of order is moved
+def youtube_insert_videos(auth, playlist_id, ids):
+    headers = {
+        'accept': 'application/json',
+        'content-type': 'application/json'
+    }
+    def insert(video, position):
+        # Not retried, so an insert that went through but errored is left to the read back rather than sent twice
+        makeRequest("https://www.googleapis.com/youtube/v3/playlistItems?part=snippet", "post", 200, headers=headers, auth=auth, retry=False, json=youtube_item_data(playlist_id, video, position))
+    failed = []
+    with ThreadPoolExecutor(max_workers=YOUTUBE_INSERT_THREADS, thread_name_prefix="youtube_insert") as executor:
+        futures = [executor.submit(metrics.carry_job(insert), video, position) for position, video in enumerate(ids)]
+        for position, future in enumerate(futures):
+            try:
+                future.result()
+            except (youtube.ApiError, requests.exceptions.RequestException):
+                failed.append(position)
+    items = youtube_playlist_items(auth, playlist_id)
+    if failed:
+        length = len(items)
+        for position in youtube_missing(items, ids, failed):
+            try:
+                insert(ids[position], min(position, length))
+            except (youtube.ApiError, requests.exceptions.RequestException): # Left out, so the rest still gets ordered
+                print("Couldn't add video " + ids[position] + " to playlist " + playlist_id)
+                traceback.print_exc()
+                continue
+            length += 1
+        items = youtube_playlist_items(auth, playlist_id)
+    youtube_reorder_playlist(auth, playlist_id, items, ids)
+
+# The body of the request that adds a video to a youtube playlist at position
+def youtube_item_data(playlist_id, video, position):
+    return {
+        "kind": "youtube#playlistItem",
+        "snippet": {
+            "playlistId": playlist_id,
+            "position": position,
+            "resourceId": {
+                "kind": "youtube#video",
+                "videoId": video
+            }
+        }
+    }
+
+# Returns the positions in failed whose insert has to be sent again, given the playlistItem objects read back after
+# inserting ids. A video is only missing if the playlist has fewer copies of it than ids, as an insert can go through
+# even though its request errored
+def youtube_missing(items, ids, failed):
+    present = Counter(item['snippet']['resourceId']['videoId'] for item in items)
+    expected = Counter(ids)
+    missing = []
+    for position in failed:
+        video = ids[position]
+        if present[video] >= expected[video]:
+            continue
+        present[video] += 1
+        missing.append(position)
+    return missing
+
+# Returns every playlistItem object of a youtube playlist, in playlist order. The page limit doesn't apply, as
+# youtube_insert_videos needs the whole playlist to tell which inserts went through
+def youtube_playlist_items(auth, playlist_id):
+    return pagination(youtube_items_url(playlist_id), "get", pages=None, auth=auth)
+
+# The url of a youtube playlist's items, 50 to a page
+def youtube_items_url(playlist_id):
+    return "https://www.googleapis.com/youtube/v3/playlistItems?part=snippet&maxResults=50&playlistId=" + playlist_id
+
+# Moves the items of a youtube playlist so their videos are in the same order as ids.
+# items should be the current playlistItem objects of the playlist, in order
+def youtube_reorder_playlist(auth, playlist_id, items, ids):
+    headers = {
+        'accept': 'application/json',
+        'content-type': 'application/json'
+    }
+    for data in youtube_moves(playlist_id, items, ids):
+        makeRequest("https://www.googleapis.com/youtube/v3/playlistItems?part=snippet", "put", 200, headers=headers, auth=auth, json=data)
+
+# Yields the bodies of the playlistItems updates that put the videos of items in the same order as ids, to be sent
+# one after another, as each position assumes the moves before it have been made
+def youtube_moves(playlist_id, items, ids):
+    order = list(items)
+    for position, video in enumerate(ids):
+        if position < len(order) and order[position]['snippet']['resourceId']['videoId'] == video:
+            continue
+        for index in range(position + 1, len(order)):
+            if order[index]['snippet']['resourceId']['videoId'] == video:
+                break
+        else:
+            continue # The video isn't in the playlist at all, nothing to move
+        item = order.pop(index)
+        order.insert(position, item)
+        yield {
+            "id": item['id'],
             "snippet": {
                 "playlistId": playlist_id,
-                "resourceId": {
-                    "kind": "youtube#video",
-                    "videoId": video
-                }
+                "position": position,
+                "resourceId": item['snippet']['resourceId']
             }
         }
-        r = makeRequest("https://www.googleapis.com/youtube/v3/playlistItems?part=snippet", "post", 200, headers=headers, json=data)
-    return playlist_id
 
 # Reads all loaded youtube playlists
 def youtube_read_playlists(auth, ids=False):
     playlists = {}
     marked_items = set()
-    headers = {
-        "authorization": "Bearer " + auth.token
-    }
-    items = pagination("https://www.googleapis.com/youtube/v3/playlists?part=snippet&mine=true&maxResults=50", "get", headers=headers)
+    items = pagination("https://www.googleapis.com/youtube/v3/playlists?part=snippet&mine=true&maxResults=50", "get", auth=auth)
     if ids:
         for item in items:
             if item['snippet']['title'] in playlists.keys():
@@ -404,34 +674,38 @@ def youtube_read_playlists(auth, ids=False):
 
 # Reads a single youtube playlist
 def youtube_read_playlist(auth, playlist_id):
-    ids_request_limit = 40
     playlist = []
-    headers = {
-        "authorization": "Bearer " + auth.token
-    }
-    items = pagination("https://www.googleapis.com/youtube/v3/playlistItems?part=snippet%2CcontentDetails&maxResults=50&playlistId=" + playlist_id, "get", headers=headers)
-    ids_str_list = []
-    ids_str = ""
-    index = 0
-    for item in items:
-        ids_str += item['contentDetails']['videoId'] + "%2C"
-        index += 1
-        if index >= ids_request_limit:
-            ids_str_list.append(ids_str)
-            ids_str = ""
-    ids_str_list.append(ids_str)
-    for ids_str in ids_str_list:
-        r = makeRequest("https://www.googleapis.com/youtube/v3/videos?part=snippet&id=" + ids_str, "get", headers=headers)
-        videoData = json.loads(r.content)
-        for item in videoData['items']:
-            track = Track(
-                item['snippet']['title'],
-                item['snippet']['channelTitle'],
-                None
-            )
-            track.update_service("youtube",item['id'])
-            playlist.append(track)
+    items = pagination("https://www.googleapis.com/youtube/v3/playlistItems?part=snippet%2CcontentDetails&maxResults=50&playlistId=" + playlist_id, "get", auth=auth)
+    for ids_str in youtube_id_chunks([item['contentDetails']['videoId'] for item in items]):
+        r = makeRequest("https://www.googleapis.com/youtube/v3/videos?part=snippet&id=" + ids_str, "get", auth=auth)
+        playlist += youtube_parse_videos(json.loads(r.content)['items'])
     return playlist
 
+# Like youtube_read_playlist, but a generator that yields a list of tracks for each page as it arrives
+def youtube_iter_playlist(auth, playlist_id):
+    for items in iter_pagination("https://www.googleapis.com/youtube/v3/playlistItems?part=snippet%2CcontentDetails&maxResults=50&playlistId=" + playlist_id, "get", auth=auth):
+        tracks = []
+        for ids_str in youtube_id_chunks([item['contentDetails']['videoId'] for item in items]):
+            r = makeRequest("https://www.googleapis.com/youtube/v3/videos?part=snippet&id=" + ids_str, "get", auth=auth)
+            tracks += youtube_parse_videos(json.loads(r.content)['items'])
+        yield tracks
+
+# Splits a list of video ids into comma seperated strings of at most YOUTUBE_IDS_CHUNKS ids, for the videos endpoint
+def youtube_id_chunks(ids):
+    return ["%2C".join(ids[i:i + YOUTUBE_IDS_CHUNKS]) for i in range(0, len(ids), YOUTUBE_IDS_CHUNKS)]
+
+# Converts the items returned by the youtube videos endpoint into track objects
+def youtube_parse_videos(items):
+    tracks = []
+    for item in items:
+        track = Track(
+            item['snippet']['title'],
+            item['snippet']['channelTitle'],
+            None
+        )
+        track.update_service("youtube",item['id'])
+        tracks.append(track)
+    return tracks
+
 if __name__ == "__main__":
     pass
\ No newline at end of file
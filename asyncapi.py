@@ -0,0 +1,325 @@
+import asyncio, json, time, traceback, aiohttp
+import apicontrol, ratelimit, httpcache, metrics, quota, searchcache, youtube
+from urllib.parse import quote
+
+# An asyncio counterpart to apicontrol and search. Every operation is a coroutine on an Engine, so hundreds of
+# requests can be in flight on a single event loop instead of needing a thread each.
+# Requests go through the same pipeline as apicontrol.sendRequest: the quota budget, the shared rate limiter, the
+# on-disk httpcache, the 401 refresh and replay, and the same retry rules. Identical GETs in flight on one engine are
+# only sent once, keyed like apicontrol's singleflight. The budget, caches and token refreshes read and write files,
+# so they are run in the loop's default executor rather than blocking the event loop.
+#
+# Headless use:
+#     async def main():
+#         async with asyncapi.Engine() as engine:
+#             return await engine.spotify_read_playlist(auth, playlist_id)
+#     tracks = asyncio.run(main())
+# From a Qt Worker (or anything else that is synchronous), asyncapi.run("spotify_read_playlist", auth, playlist_id)
+# does the same thing on a fresh event loop in the calling thread. headless.py --async uses it for its reads and writes.
+
+SERVICE_CONCURRENCY = {  # How many requests each service can have in flight at once
+    "spotify": 16,
+    "youtube": 16
+}
+REQUEST_TIMEOUT = 30     # Seconds before a single request is abandoned
+
+# The parts of a requests.Response that apicontrol's helpers use, filled in from an aiohttp response
+class Response:
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+# Works out which service a url belongs to, for picking its concurrency limit
+def service_of(url):
+    if "spotify.com" in url:
+        return "spotify"
+    else:
+        return "youtube"
+
+# Runs a blocking function, such as a file read or a token refresh, in the running loop's default executor, under
+# the caller's metrics job
+async def blocking(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, metrics.carry_job(fn), *args)
+
+class Engine:
+    def __init__(self, concurrency=None):
+        self.concurrency = dict(SERVICE_CONCURRENCY)
+        if concurrency:
+            self.concurrency.update(concurrency)
+        for service, amount in self.concurrency.items():
+            if amount < 1:
+                raise ValueError("Concurrency for " + service + " must be at least 1")
+        self.semaphores = {}
+        self.flights = {}        # flight key to the future of the request in progress
+        self.session = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def open(self):
+        if self.session == None:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT))
+
+    async def close(self):
+        if self.session != None:
+            await self.session.close()
+            self.session = None
+
+    # Semaphores have to be made inside the running event loop, so they are created on first use
+    def semaphore(self, service):
+        if not service in self.semaphores:
+            self.semaphores[service] = asyncio.Semaphore(self.concurrency[service])
+        return self.semaphores[service]
+
+    # Async version of apicontrol.makeRequest, with the same arguments. A GET that is already in flight on this
+    # engine is awaited instead of being sent again
+    async def request(self, url, method="get", expectedCode=200, auth=None, retry=True, **kwargs):
+        key = apicontrol.flight_key(url, method, expectedCode, auth, kwargs)
+        if key == None:
+            return await self.send(url, method, expectedCode, auth, retry, **kwargs)
+        flight = self.flights.get(key)
+        if flight != None:
+            metrics.registry.coalesced(method, url)
+            return await asyncio.shield(flight)
+        flight = self.flights[key] = asyncio.ensure_future(self.send(url, method, expectedCode, auth, retry, **kwargs))
+        flight.add_done_callback(lambda done: self.flights.pop(key, None))
+        return await asyncio.shield(flight) # Shielded, so one caller being cancelled doesn't cancel the others
+
+    # Async version of apicontrol.sendRequest
+    async def send(self, url, method="get", expectedCode=200, auth=None, retry=True, **kwargs):
+        await self.open()
+        retries = 0
+        replayed = False
+        cacheKey, cached = await blocking(apicontrol.cache_lookup, url, method, expectedCode, kwargs)
+        if cached and cached.fresh():
+            return cached.response()
+        if cached:
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, **cached.validators())
+        async with self.semaphore(service_of(url)):
+            while True:
+                await blocking(quota.budget.charge, method, url) # Raises youtube.QuotaError rather than going over the daily budget
+                delay = ratelimit.limiter.delay(url)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if auth != None:
+                    sent = await self.bearer(auth)
+                    kwargs['headers'] = dict(kwargs.get('headers') or {}, authorization="Bearer " + sent)
+                start = time.perf_counter()
+                try:
+                    async with self.session.request(method, url, **kwargs) as resp:
+                        r = Response(str(resp.url), resp.status, resp.headers, await resp.read())
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    metrics.registry.request(method, url, time.perf_counter() - start)
+                    retries += 1
+                    if not retry or retries >= apicontrol.RETRY_ATTEMPTS:
+                        raise e
+                    metrics.registry.retry(method, url)
+                    await asyncio.sleep(ratelimit.backoff(retries, apicontrol.ERR_DELAY))
+                    continue
+                metrics.registry.request(method, url, time.perf_counter() - start, r.status_code, len(r.content))
+                result = apicontrol.outcome(r, expectedCode, cached, auth, replayed)
+                if result == "throttled":
+                    metrics.registry.throttle(method, url)
+                    ratelimit.limiter.throttled(url, r, apicontrol.TMR_DELAY)
+                    continue
+                elif result == "ok":
+                    ratelimit.limiter.succeeded(url)
+                    if cacheKey:
+                        await blocking(httpcache.cache.put, cacheKey, url, r)
+                    return r
+                elif result == "not_modified":
+                    ratelimit.limiter.succeeded(url)
+                    await blocking(httpcache.cache.revalidated, cacheKey)
+                    return cached.response()
+                elif result == "reauthorize": # Only replayed once, so a revoked token still errors
+                    replayed = True
+                    metrics.registry.reauthorized(method, url)
+                    await blocking(auth.ensure_fresh, sent)
+                    continue
+                elif result == "server_error":
+                    metrics.registry.server_error(method, url)
+                    retries += 1
+                    if not retry or retries >= apicontrol.RETRY_ATTEMPTS:
+                        break
+                    metrics.registry.retry(method, url)
+                    await asyncio.sleep(ratelimit.backoff(retries, apicontrol.ERR_DELAY))
+                    continue
+                else:
+                    break
+        raise apicontrol.api_error(url, r, expectedCode)
+
+    # The access token to send, like auth.token. Only a token that is about to expire is refreshed, in the executor
+    async def bearer(self, auth):
+        if auth.access_token == None or auth.valid():
+            return auth.access_token
+        return await blocking(auth.ensure_fresh)
+
+    # Async version of apicontrol.pagination. Offset based pages are all requested at once
+    async def pagination(self, url, method="get", pages=apicontrol.PAGINATION_PAGES, **kwargs):
+        r = await self.request(url, method, params={}, **kwargs)
+        data = json.loads(r.content)
+        items = data['items']
+        page_urls = apicontrol.offset_urls(data, pages)
+        if page_urls:
+            responses = await asyncio.gather(*[self.request(page_url, method, **kwargs) for page_url in page_urls])
+            for r in responses: # gather returns the pages in order, so the items stay in playlist order
+                items += json.loads(r.content)['items']
+            return items
+        page = 1
+        while pages == None or page < pages:
+            page += 1
+            following = apicontrol.next_page(url, data)
+            if following == None:
+                break
+            url, params = following
+            r = await self.request(url, method, params=params, **kwargs)
+            data = json.loads(r.content)
+            items += data['items']
+        return items
+
+    async def spotify_read_playlist(self, auth, playlist_id, album=False):
+        if album:
+            items = await self.pagination("https://api.spotify.com/v1/albums/" + playlist_id + "/tracks", auth=auth)
+        else:
+            items = await self.pagination("https://api.spotify.com/v1/playlists/" + playlist_id + "/tracks", auth=auth)
+        return apicontrol.spotify_parse_tracks(items, album)
+
+    # Reads all of the user's spotify playlists. With ids=False, every playlist is read concurrently
+    async def spotify_read_playlists(self, auth, ids=False):
+        items = await self.pagination("https://api.spotify.com/v1/me/playlists", auth=auth)
+        if ids:
+            return unique_names({item['id']: item['name'] for item in items})
+        results = await asyncio.gather(*[self.spotify_read_playlist(auth, item['id']) for item in items])
+        return {item['name']: tracks for item, tracks in zip(items, results)}
+
+    async def youtube_read_playlist(self, auth, playlist_id):
+        items = await self.pagination("https://www.googleapis.com/youtube/v3/playlistItems?part=snippet%2CcontentDetails&maxResults=50&playlistId=" + playlist_id, auth=auth)
+        chunks = apicontrol.youtube_id_chunks([item['contentDetails']['videoId'] for item in items])
+        responses = await asyncio.gather(*[self.request("https://www.googleapis.com/youtube/v3/videos?part=snippet&id=" + ids_str, auth=auth) for ids_str in chunks])
+        playlist = []
+        for r in responses:
+            playlist += apicontrol.youtube_parse_videos(json.loads(r.content)['items'])
+        return playlist
+
+    # Reads all of the user's youtube playlists. With ids=False, every playlist is read concurrently
+    async def youtube_read_playlists(self, auth, ids=False):
+        items = await self.pagination("https://www.googleapis.com/youtube/v3/playlists?part=snippet&mine=true&maxResults=50", auth=auth)
+        if ids:
+            return unique_names({item['id']: item['snippet']['title'] for item in items})
+        results = await asyncio.gather(*[self.youtube_read_playlist(auth, item['id']) for item in items])
+        return {item['snippet']['title']: tracks for item, tracks in zip(items, results)}
+
+    # Spotify appends tracks in the order they are sent, so the chunks are added one after another
+    async def spotify_write_playlist(self, auth, name, desc, tracks, public=True):
+        ids = ["spotify:track:" + track.services['spotify']['id'] for track in tracks if track.services['spotify']['id']]
+        headers = {"content-type": "application/json"}
+        data = {
+            "name": name,
+            "description": desc,
+            "public": public
+        }
+        r = await self.request("https://api.spotify.com/v1/users/" + auth.username + "/playlists", "post", 201, json=data, headers=headers, auth=auth)
+        playlist_id = json.loads(r.content)['id']
+        for i in range(0, len(ids), apicontrol.SPOTIFY_IDS_CHUNKS):
+            chunk = {"uris": ids[i:i + apicontrol.SPOTIFY_IDS_CHUNKS]}
+            await self.request("https://api.spotify.com/v1/users/" + auth.username + "/playlists/" + playlist_id + "/tracks", "post", 201, json=chunk, headers=headers, auth=auth)
+        return playlist_id
+
+    async def youtube_write_playlist(self, auth, name, desc, tracks, public=True):
+        ids = [track.services['youtube']['id'] for track in tracks if track.services['youtube']['id']]
+        headers = {
+            'accept': 'application/json',
+            'content-type': 'application/json'
+        }
+        r = await self.request("https://www.googleapis.com/youtube/v3/playlists?part=snippet%2Cstatus", "post", 200, headers=headers, auth=auth, json=apicontrol.youtube_playlist_data(name, desc, public))
+        playlist_id = json.loads(r.content)['id']
+        await self.youtube_insert_videos(auth, playlist_id, ids)
+        return playlist_id
+
+    # Async version of apicontrol.youtube_insert_videos: up to YOUTUBE_INSERT_THREADS positioned inserts at once, then
+    # the same read back, repair and reorder
+    async def youtube_insert_videos(self, auth, playlist_id, ids):
+        headers = {
+            'accept': 'application/json',
+            'content-type': 'application/json'
+        }
+        inserts = asyncio.Semaphore(apicontrol.YOUTUBE_INSERT_THREADS)
+        async def insert(video, position):
+            async with inserts:
+                # Not retried, so an insert that went through but errored is left to the read back rather than sent twice
+                await self.request("https://www.googleapis.com/youtube/v3/playlistItems?part=snippet", "post", 200, headers=headers, auth=auth, retry=False, json=apicontrol.youtube_item_data(playlist_id, video, position))
+        results = await asyncio.gather(*[insert(video, position) for position, video in enumerate(ids)], return_exceptions=True)
+        failed = []
+        for position, result in enumerate(results):
+            if isinstance(result, (youtube.ApiError, aiohttp.ClientError, asyncio.TimeoutError)):
+                failed.append(position)
+            elif isinstance(result, BaseException):
+                raise result
+        items = await self.pagination(apicontrol.youtube_items_url(playlist_id), pages=None, auth=auth)
+        if failed:
+            length = len(items)
+            for position in apicontrol.youtube_missing(items, ids, failed):
+                try:
+                    await insert(ids[position], min(position, length))
+                except (youtube.ApiError, aiohttp.ClientError, asyncio.TimeoutError): # Left out, so the rest still gets ordered
+                    print("Couldn't add video " + ids[position] + " to playlist " + playlist_id)
+                    traceback.print_exc()
+                    continue
+                length += 1
+            items = await self.pagination(apicontrol.youtube_items_url(playlist_id), pages=None, auth=auth)
+        for data in apicontrol.youtube_moves(playlist_id, items, ids):
+            await self.request("https://www.googleapis.com/youtube/v3/playlistItems?part=snippet", "put", 200, headers=headers, auth=auth, json=data)
+
+    # Async version of search.spotify_search, sharing its searchcache
+    async def spotify_search(self, keywords, content_type, auth, amount=1, cached=True):
+        valid_types = ["artist","album","track","playlist"]
+        if not content_type in valid_types: raise ValueError("Invalid Type - " + content_type)
+        if cached:
+            data = await blocking(searchcache.cache.get, "spotify", content_type, keywords, amount)
+            if data != None: return data
+        r = await self.request("https://api.spotify.com/v1/search?q=" + quote(keywords) + "&type=" + content_type + "&limit=" + str(amount), auth=auth)
+        data = json.loads(r.text)[content_type + "s"]['items']
+        await blocking(searchcache.cache.put, "spotify", content_type, keywords, amount, data)
+        return data
+
+    # Async version of search.youtube_search, sharing its searchcache
+    async def youtube_search(self, keywords, content_type, auth, amount=1, cached=True):
+        valid_types = ["video","channel","playlist"]
+        if not content_type in valid_types: raise ValueError("Invalid Type - " + content_type)
+        if cached:
+            data = await blocking(searchcache.cache.get, "youtube", content_type, keywords, amount)
+            if data != None: return data
+        r = await self.request("https://www.googleapis.com/youtube/v3/search?q=" + quote(keywords) + "&part=snippet&maxResults=" + str(amount) + "&type=" + content_type, auth=auth)
+        data = json.loads(r.text)['items']
+        await blocking(searchcache.cache.put, "youtube", content_type, keywords, amount, data)
+        return data
+
+# Turns {id: name} into {name: id}, adding the id to any names that appear more than once, like spotify_read_playlists does
+def unique_names(names):
+    counts = {}
+    for name in names.values():
+        counts[name] = counts.get(name, 0) + 1
+    playlists = {}
+    for playlist_id, name in names.items():
+        if counts[name] > 1:
+            playlists[name + " (" + playlist_id + ")"] = playlist_id
+        else:
+            playlists[name] = playlist_id
+    return playlists
+
+# Runs a single Engine operation to completion from synchronous code, such as a Qt Worker or a script
+def run(operation, *args, **kwargs):
+    async def main():
+        async with Engine() as engine:
+            return await getattr(engine, operation)(*args, **kwargs)
+    return asyncio.run(main())
@@ -0,0 +1,72 @@
+import sys, os, json, time, argparse, statistics, subprocess
+
+# Measures how long the GUI takes from a cold start to the first paint of MenuWrapper, by starting a fresh Python
+# process for every run. Run from anywhere:
+#   python benchmarks/startup.py --runs 10
+#   python benchmarks/startup.py --eager       (imports QtWebEngine, mutagen and isodate up front, like main.py used to)
+# Add --offscreen to run without a display. Accounts that are signed in are refreshed on start, so results are
+# steadier when the app is logged out
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["PyQt5.QtWebEngineWidgets", "mutagen.mp3", "isodate"] # Only imported by the features that need them
+
+# Run in each child process, with the parent's start time and whether to import HEAVY_MODULES first as arguments
+CHILD = """
+import sys, time, json
+start, eager, heavy = float(sys.argv[1]), sys.argv[2] == "1", sys.argv[3].split(",")
+if eager:
+    for module in heavy: __import__(module)
+import main
+imported = time.time()
+from PyQt5.QtCore import QObject, QEvent, QCoreApplication, QTimer, Qt
+from PyQt5.QtWidgets import QApplication
+QCoreApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
+app = QApplication(sys.argv[:1])
+
+class FirstPaint(QObject):
+    painted = None
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Paint and self.painted == None:
+            self.painted = time.time()
+            QTimer.singleShot(0, app.quit)
+        return False
+
+watcher = FirstPaint()
+app.installEventFilter(watcher)
+win = main.MenuWrapper()
+created = time.time()
+QTimer.singleShot(30000, app.quit) # Give up if nothing is ever painted
+app.exec_()
+print(json.dumps({
+    "import": imported - start,
+    "window": created - start,
+    "paint": None if watcher.painted == None else watcher.painted - start,
+    "loaded": [module for module in heavy if module in sys.modules]
+}))
+"""
+
+# Starts the GUI once, returning the child's timings in seconds since the process was started
+def run_once(eager, env):
+    start = time.time()
+    output = subprocess.run([sys.executable, "-c", CHILD, str(start), "1" if eager else "0", ",".join(HEAVY_MODULES)],
+        cwd=ROOT, env=env, stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Time from a cold start to the first paint of the main window")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--eager", action="store_true", help="import " + ", ".join(HEAVY_MODULES) + " before main")
+    parser.add_argument("--offscreen", action="store_true", help="use Qt's offscreen platform, for machines without a display")
+    args = parser.parse_args()
+    env = dict(os.environ)
+    if args.offscreen: env['QT_QPA_PLATFORM'] = "offscreen"
+    results = [run_once(args.eager, env) for run in range(args.runs)]
+    for name in ["import", "window", "paint"]:
+        times = [result[name] for result in results if result[name] != None]
+        if times:
+            print("%-8s median %6.0f ms   min %6.0f ms   max %6.0f ms" % (name, statistics.median(times) * 1000, min(times) * 1000, max(times) * 1000))
+        else:
+            print("%-8s never happened" % name)
+    print("Heavy modules loaded at first paint: " + (", ".join(results[-1]['loaded']) or "none"))
+
+if __name__ == "__main__": main()
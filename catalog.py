@@ -0,0 +1,108 @@
+import os, json, time, threading
+import apicontrol
+
+CATALOG_DIR = "data/catalog"
+CATALOG_TTL = 7 * 24 * 60 * 60 # How long, in seconds, a saved discography is used before it is fetched again
+
+# Turns a track object into a short list, as discographies can be thousands of tracks long
+def compact(track):
+    return [
+        track.title,
+        track.artist,
+        track.album,
+        track.services['spotify']['id'],
+        track.services['spotify']['duration']
+    ]
+
+def expand(row):
+    title, artist, album, spotify_id, duration = row
+    track = apicontrol.Track(title, artist, album)
+    track.update_service("spotify", spotify_id)
+    track.update_duration("spotify", duration)
+    return track
+
+# A cache of artist discographies, keyed by Spotify artist id. Discographies are kept in memory and in a file per artist
+# under CATALOG_DIR, so they are shared by every thread and survive restarts. Only one thread crawls a given artist
+# at a time; any others asking for the same artist wait for it and then use what it saved.
+# A crawl that is stopped early is saved as incomplete, and the next crawl of that artist carries on from where it stopped
+class CatalogCache:
+    def __init__(self, directory=CATALOG_DIR, ttl=CATALOG_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        self.memory = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def filename(self, artist_id):
+        return os.path.join(self.directory, artist_id + ".json")
+
+    def artist_lock(self, artist_id):
+        with self.lock:
+            if not artist_id in self.locks:
+                self.locks[artist_id] = threading.Lock()
+            return self.locks[artist_id]
+
+    # Returns the saved entry for an artist if it hasn't expired, otherwise None
+    def load(self, artist_id):
+        entry = self.memory.get(artist_id)
+        if entry == None:
+            try:
+                with open(self.filename(artist_id)) as f:
+                    entry = json.loads(f.read())
+            except (OSError, ValueError):
+                return None
+            self.memory[artist_id] = entry
+        if time.time() - entry['time'] >= self.ttl:
+            return None
+        return entry
+
+    def save(self, artist_id, entry):
+        self.memory[artist_id] = entry
+        if not os.path.isdir(self.directory): os.makedirs(self.directory)
+        temp = self.filename(artist_id) + ".tmp"
+        with open(temp, "w") as f:
+            f.write(json.dumps(entry))
+        os.replace(temp, self.filename(artist_id))
+
+    # A generator of lists of an artist's tracks. Saved tracks are yielded first, as one list. If the saved discography
+    # is incomplete, crawl(skip) is then used to get the rest: it should be a generator of (album_id, tracks) that
+    # leaves out the album ids in skip. Whatever has been crawled is saved when the generator finishes or is closed
+    def iter_tracks(self, artist_id, crawl):
+        with self.artist_lock(artist_id):
+            entry = self.load(artist_id)
+        if entry != None and entry.get('complete', True):
+            # A complete discography isn't changed again, so it's used without holding up other threads
+            if entry['tracks']:
+                yield [expand(row) for row in entry['tracks']]
+            return
+        with self.artist_lock(artist_id):
+            entry = self.load(artist_id) # Another thread may have finished crawling the artist while this one waited
+            if entry == None:
+                entry = {"time": time.time(), "complete": False, "albums": [], "tracks": []}
+            if entry['tracks']:
+                yield [expand(row) for row in entry['tracks']]
+            if entry.get('complete', True):
+                return
+            changed = False
+            try:
+                for album_id, tracks in crawl(set(entry['albums'])):
+                    entry['albums'].append(album_id)
+                    entry['tracks'] += [compact(track) for track in tracks]
+                    changed = True
+                    yield tracks
+                entry['complete'] = True
+                changed = True
+            finally:
+                if changed:
+                    self.save(artist_id, entry)
+
+    # Removes every saved discography
+    def clear(self):
+        with self.lock:
+            self.memory = {}
+            if os.path.isdir(self.directory):
+                for filename in os.listdir(self.directory):
+                    os.remove(os.path.join(self.directory, filename))
+
+# The cache used by search.spotify_iter_tracks
+cache = CatalogCache()
@@ -0,0 +1,82 @@
+import os, json, threading
+
+CREDS_FILE = "api_creds.json"
+
+# Environment variables used for a service's credentials when there is no credentials file, e.g. in containers
+ENV_CREDENTIALS = {
+    "spotify": ("SPOTIFY_CLIENT_ID", "SPOTIFY_CLIENT_SECRET"),
+    "youtube": ("YOUTUBE_CLIENT_ID", "YOUTUBE_CLIENT_SECRET"),
+}
+
+class CredentialsError(Exception):
+    """
+    Raised when a service's client id and secret can't be found in the credentials file or the environment
+
+    Args:
+        service: The service the credentials were needed for
+    """
+    def __init__(self, service):
+        self.service = service
+        names = ENV_CREDENTIALS.get(service, ())
+        Exception.__init__(self, "No " + service + " credentials found in " + CREDS_FILE + " or " + " and ".join(names))
+
+# Reads credentials in the format of api_creds.json: {"spotify": {"client_id": ..., "client_secret": ...}, "youtube": ...}
+def file_credentials(filename=CREDS_FILE):
+    with open(filename) as f:
+        return json.loads(f.read())
+
+# Reads credentials from the variables in ENV_CREDENTIALS, leaving out services that don't have both set
+def env_credentials():
+    credentials = {}
+    for service, (id_name, secret_name) in ENV_CREDENTIALS.items():
+        if os.environ.get(id_name) and os.environ.get(secret_name):
+            credentials[service] = {"client_id": os.environ[id_name], "client_secret": os.environ[secret_name]}
+    return credentials
+
+# The default source of credentials: CREDS_FILE if it exists, otherwise the environment
+def default_credentials():
+    if os.path.isfile(CREDS_FILE):
+        return file_credentials(CREDS_FILE)
+    return env_credentials()
+
+# The client credentials used by the spotify and youtube modules. Nothing is read until a token is first needed,
+# so importing the API modules doesn't touch the disk. loader is any function returning a dict in the format of
+# api_creds.json, so credentials can come from somewhere else, e.g. Config(lambda: {"spotify": {...}}) in a test
+class Config:
+    def __init__(self, loader=default_credentials):
+        self.loader = loader
+        self.data = None
+        self.lock = threading.Lock()
+
+    # Returns (client_id, client_secret) for a service
+    def credentials(self, service):
+        with self.lock:
+            if self.data == None:
+                self.data = self.loader()
+        creds = self.data.get(service)
+        if not creds:
+            raise CredentialsError(service)
+        return creds['client_id'], creds['client_secret']
+
+    # Forgets the loaded credentials, so they are read again on next use
+    def reload(self):
+        with self.lock:
+            self.data = None
+
+# Creates a file with default contents, and its directory, if it doesn't exist yet. Used for the auth token stores
+def ensure_file(filename, default):
+    if os.path.isfile(filename):
+        return filename
+    head, tail = os.path.split(filename)
+    if head and not os.path.isdir(head): os.makedirs(head)
+    with open(filename, "w") as f:
+        f.write(default)
+    return filename
+
+# The configuration used by spotify and youtube
+settings = Config()
+
+# Replaces the shared configuration, e.g. with one using a different source of credentials
+def use(new_settings):
+    global settings
+    settings = new_settings
@@ -0,0 +1,79 @@
+import requests, threading, time, metrics
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+
+POOL_SIZE = 4            # Default amount of keep-alive connections kept open per host. Should match the thread count
+POOL_BLOCK = False       # If True, threads wait for a free connection instead of opening a temporary extra one
+
+# A shared HTTP client that keeps one requests.Session per host, so connections (and their TLS handshakes)
+# are reused between requests rather than being rebuilt every time.
+# The underlying urllib3 connection pools are thread safe, so a single client can be used by every worker thread
+class Client:
+    def __init__(self, pool_size=POOL_SIZE):
+        self.pool_size = pool_size
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    # Returns the session for the host of the specified url, creating it if it doesn't exist yet
+    def session(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            session = self.sessions.get(host)
+            if session == None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=POOL_BLOCK)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self.sessions[host] = session
+            return session
+
+    # Changes the amount of connections kept per host. Existing sessions are closed and recreated on next use
+    def set_pool_size(self, pool_size):
+        with self.lock:
+            if pool_size == self.pool_size:
+                return
+            self.pool_size = pool_size
+            sessions = self.sessions
+            self.sessions = {}
+        for session in sessions.values():
+            session.close()
+
+    # Same signature as requests.request. Every request is timed and recorded in metrics.registry
+    def request(self, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            r = self.session(url).request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            metrics.registry.request(method, url, time.perf_counter() - start)
+            raise
+        metrics.registry.request(method, url, time.perf_counter() - start, r.status_code, len(r.content))
+        return r
+
+    def get(self, url, **kwargs):
+        return self.request("get", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("post", url, **kwargs)
+
+    # Closes every open connection
+    def close(self):
+        with self.lock:
+            sessions = self.sessions
+            self.sessions = {}
+        for session in sessions.values():
+            session.close()
+
+# The client shared by apicontrol, search and the token classes
+client = Client()
+
+def request(method, url, **kwargs):
+    return client.request(method, url, **kwargs)
+
+def get(url, **kwargs):
+    return client.get(url, **kwargs)
+
+def post(url, **kwargs):
+    return client.post(url, **kwargs)
+
+def set_pool_size(pool_size):
+    client.set_pool_size(pool_size)
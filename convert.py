@@ -0,0 +1,137 @@
+import apicontrol, search, youtube, journal, metrics, threading, traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# How many tracks are converted at once, by the service they are converted to. The limits are shared by every
+# conversion running at the same time, so updating a whole table while fetching single rows doesn't go over them
+SERVICE_CONCURRENCY = {
+    "spotify": 4,        # youtube_to_spotify makes several cheap requests per track
+    "youtube": 3,        # spotify_to_youtube is mostly one search, which is the expensive part of the quota
+}
+
+limits = {service: threading.BoundedSemaphore(amount) for service, amount in SERVICE_CONCURRENCY.items()}
+limits_lock = threading.Lock()
+
+# Changes how many tracks can be converted to a service at once. Conversions already running keep the limit they
+# started with. Call connection.set_pool_size with max_connections() afterwards if the limit was raised
+def set_concurrency(service, amount):
+    if amount < 1:
+        raise ValueError("Concurrency for " + service + " must be at least 1")
+    with limits_lock:
+        SERVICE_CONCURRENCY[service] = amount
+        limits[service] = threading.BoundedSemaphore(amount)
+
+# The most requests a conversion can have in flight to one host, as each track being converted can be fetching the
+# pages of an album PAGINATION_THREADS at a time. Used to size the connection pools so none are opened and thrown away
+def max_connections():
+    return max(SERVICE_CONCURRENCY.values()) * apicontrol.PAGINATION_THREADS
+
+# Returns the indexes of the tracks that don't have a link for service yet, out of the selected ones if given
+def pending(tracks, service, selected=None):
+    indexes = []
+    for i, track in enumerate(tracks):
+        if selected != None and not i in selected:
+            continue
+        if track.services[service]['id'] != None:
+            continue
+        indexes.append(i)
+    return indexes
+
+# Returns the indexes of the pending tracks that a journal from an earlier, unfinished run of the same conversion
+# hasn't done yet, i.e. the tracks the conversion will actually search for. Used to estimate the quota a run needs
+def remaining(tracks, service, selected=None):
+    indexes = pending(tracks, service, selected)
+    finished = journal.Journal(journal.job_id(service, tracks)).load()
+    return [i for i in indexes if not i in finished]
+
+# Finds a single track on service, returning the updated track or None if it couldn't be found. durations can be
+# shared between calls, so no YouTube video is looked up twice. convert_tracks pools the lookups with search.DurationPool instead
+def convert_track(track, service, auth, durations=None):
+    if service == "spotify":
+        return search.youtube_to_spotify(track, auth)
+    else:
+        return search.spotify_to_youtube(track, auth, durations)
+
+# Converts every pending track in tracks to service, up to concurrency tracks at a time, replacing them in the list
+# in place so the table order is kept. progress, if given, is called with the percentage of tracks finished.
+# Each finished track is written to a journal, so if the job stops early, running it again on the same tracks
+# carries on where it stopped. The journal is removed once the job finishes.
+# concurrency can only lower the service's limit for this conversion, as the limit is shared with every other one;
+# use set_concurrency to raise it.
+# If the YouTube quota runs out, tracks that haven't started are skipped and youtube.QuotaError is raised once the
+# running ones finish. The tracks converted so far are in tracks, which is also attached to the error as error.tracks
+def convert_tracks(tracks, service, auth, progress=None, selected=None, concurrency=None, resume=True):
+    with limits_lock:
+        limit = limits[service]
+        if concurrency == None: concurrency = SERVICE_CONCURRENCY[service]
+        if concurrency > SERVICE_CONCURRENCY[service]:
+            raise ValueError("Concurrency " + str(concurrency) + " is over the " + service + " limit of " + str(SERVICE_CONCURRENCY[service]) + ", see convert.set_concurrency")
+    indexes = pending(tracks, service, selected)
+    record = journal.Journal(journal.job_id(service, tracks))
+    finished = record.load() if resume else {}
+    for i, new_track in finished.items():
+        if i in indexes and new_track != None:
+            tracks[i] = new_track
+    remaining = [i for i in indexes if not i in finished]
+    if finished: print("Resuming conversion, " + str(len(indexes) - len(remaining)) + " tracks already done")
+    job = metrics.current_job() # Worker threads don't inherit the job, so requests are counted under the caller's
+    pool = search.DurationPool(auth)
+    stop = threading.Event()
+    error = None
+
+    # Converts a track to YouTube in two steps: the search, which counts against the limit, then the duration lookup,
+    # which waits outside it for the pool to gather the candidates of other tracks into the same videos.list call.
+    # Returns the same as run
+    def to_youtube(track):
+        with pool.searching_track():
+            with limit:
+                if stop.is_set():
+                    return "skipped", None
+                results = search.youtube_candidates(track, auth)
+            durations = pool.lookup([result['id']['videoId'] for result in results])
+        return "done", search.choose_video(track, results, durations)
+
+    # Returns whether the track was converted ("done"), errored ("error") or never started ("skipped"), and the track
+    def run(i):
+        with metrics.job(job):
+            try:
+                if service == "youtube":
+                    return to_youtube(tracks[i])
+                with limit:
+                    if stop.is_set():
+                        return "skipped", None
+                    return "done", convert_track(tracks[i], service, auth)
+            except youtube.QuotaError: # Every track after this one would fail too, so the conversion needs to stop
+                raise
+            except Exception as e: # So a single track erroring doesn't stop the rest. It isn't recorded, so it's tried again on resume
+                traceback.print_exc()
+                return "error", None
+
+    # Tracks waiting on the pool hold a worker without holding the limit, so YouTube conversions get enough extra
+    # workers for the searches to carry on while a full videos.list call is gathered
+    workers = concurrency + (search.VIDEO_IDS_CHUNKS // search.VIDEO_RESULTS if service == "youtube" else 0)
+    if progress != None: progress(round((len(indexes) - len(remaining)) / max(1, len(indexes)) * 100))
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(remaining))), thread_name_prefix="convert_" + service) as executor:
+        futures = {executor.submit(run, i): i for i in remaining}
+        for done, future in enumerate(as_completed(futures), len(indexes) - len(remaining) + 1):
+            i = futures[future]
+            try:
+                status, new_track = future.result()
+            except youtube.QuotaError as e:
+                stop.set()
+                error = e
+                status, new_track = "error", None
+            if status == "done":
+                record.record(i, new_track)
+            if status != "skipped":
+                if new_track == None:
+                    print(str(tracks[i]) + " failed to update")
+                else:
+                    print(str(tracks[i]) + " updated")
+                    tracks[i] = new_track
+            if progress != None: progress(round(done / len(indexes) * 100))
+    if error != None:
+        error.tracks = tracks
+        raise error # The journal is kept, so the job can be resumed once there's quota again
+    record.remove()
+    if progress != None: progress(100)
+    return tracks
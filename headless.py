@@ -0,0 +1,155 @@
+import sys, os, json, time, argparse, contextlib, traceback
+import apicontrol, connection, convert, metrics, quota, spotify, youtube
+
+# Converts a playlist without the GUI, for servers, cron jobs and containers. PyQt is never imported.
+# Progress is written to stdout as JSON lines, one object per event, and everything else is written to stderr.
+# Only accounts that have already signed in through the app can be used, as signing in needs a browser. e.g.
+#   python headless.py --from spotify 37i9dQZF1DXcBWIGoYBM5M --to youtube --create "Today's Top Hits"
+#   python headless.py --from json "Road Trip" --to spotify --output road_trip.json
+# With --async, the playlist is read and the new one created with asyncapi's engine instead of apicontrol's threads
+
+playlist_file = "data/playlists.json"
+spotify_scope = "playlist-read-private playlist-modify-public playlist-modify-private" # Same scopes as main.py
+youtube_scope = "youtube"
+
+EXIT_ERROR = 1
+EXIT_QUOTA = 3           # argparse uses 2 for bad arguments
+
+class Error(Exception):
+    pass
+
+# Writes JSON lines events to a stream
+class Reporter:
+    def __init__(self, stream):
+        self.stream = stream
+        self.percent = None
+
+    def emit(self, event, **fields):
+        fields = dict({"event": event, "time": round(time.time(), 3)}, **fields)
+        self.stream.write(json.dumps(fields) + "\n")
+        self.stream.flush()
+
+    # Passed to convert.convert_tracks. Only changes are written, as the engine can report the same percentage twice
+    def progress(self, percent):
+        if percent != self.percent:
+            self.percent = percent
+            self.emit("progress", percent=percent)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Convert a playlist between Spotify and YouTube without the GUI")
+    parser.add_argument("--from", dest="source", required=True, choices=["spotify", "youtube", "json"], help="where to read the playlist from")
+    parser.add_argument("playlist", help="a Spotify or YouTube playlist id, or the name of a playlist in " + playlist_file)
+    parser.add_argument("--to", dest="target", required=True, choices=["spotify", "youtube"], help="the service to find the tracks on")
+    parser.add_argument("--create", dest="name", metavar="NAME", help="create a playlist with this name on the target service")
+    parser.add_argument("--description", default="", help="description of the created playlist")
+    parser.add_argument("--private", action="store_true", help="make the created playlist private (unlisted on YouTube)")
+    parser.add_argument("--save", help="save the converted tracks in " + playlist_file + " under this name")
+    parser.add_argument("--output", help="write the converted tracks to this JSON file")
+    parser.add_argument("--spotify-user", help="the Spotify account to use, if more than one has signed in")
+    parser.add_argument("--youtube-user", help="the YouTube account to use, if more than one has signed in")
+    parser.add_argument("--concurrency", type=int, help="how many tracks to convert at once (default " + str(convert.SERVICE_CONCURRENCY) + ")")
+    parser.add_argument("--fresh", action="store_true", help="ignore the journal of an earlier, unfinished run")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="read and create playlists with the asyncio engine (needs aiohttp)")
+    return parser.parse_args(argv)
+
+# Returns a token for a saved account, as there's no browser to sign in with
+def get_auth(service, username=None):
+    module, scope = (spotify, spotify_scope) if service == "spotify" else (youtube, youtube_scope)
+    usernames = [auth['username'] for auth in module.token(scope, request=True).auths]
+    if username == None:
+        if len(set(usernames)) != 1:
+            raise Error("Pass --" + service + "-user, one of " + str(sorted(set(usernames))) if usernames else
+                        "No " + service + " account has signed in. Sign in through the app first")
+        username = usernames[0]
+    elif not username in usernames:
+        raise Error(username + " has not signed in to " + service + " through the app")
+    return module.shared_token(scope, username)
+
+# Imports asyncapi for --async. It's only imported when asked for, as aiohttp is optional
+def load_asyncapi():
+    try:
+        import asyncapi
+    except ImportError:
+        raise Error("--async needs aiohttp, install it with pip install aiohttp")
+    return asyncapi
+
+def read_tracks(source, playlist, auth, use_async=False):
+    if source in ("spotify", "youtube"):
+        if use_async:
+            return load_asyncapi().run(source + "_read_playlist", auth, playlist)
+        return getattr(apicontrol, source + "_read_playlist")(auth, playlist)
+    with open(playlist_file) as f:
+        playlists = json.loads(f.read() or "{}")
+    if not playlist in playlists:
+        raise Error("No playlist called " + playlist + " in " + playlist_file)
+    return [apicontrol.track_from_dict(track) for track in playlists[playlist]]
+
+def save_tracks(name, tracks):
+    try:
+        with open(playlist_file) as f:
+            playlists = json.loads(f.read() or "{}")
+    except OSError:
+        playlists = {}
+    playlists[name] = [track.to_dict() for track in tracks]
+    head, tail = os.path.split(playlist_file)
+    if head and not os.path.isdir(head): os.makedirs(head)
+    with open(playlist_file, "w") as f:
+        f.write(json.dumps(playlists))
+
+def run(args, reporter):
+    if args.use_async: load_asyncapi() # Fails before the conversion, rather than after it, if aiohttp is missing
+    if args.concurrency != None:
+        convert.set_concurrency(args.target, args.concurrency)
+    connection.set_pool_size(max(convert.max_connections(), apicontrol.YOUTUBE_INSERT_THREADS))
+    auths = {}
+    for service in set([args.source, args.target]) - {"json"}:
+        auths[service] = get_auth(service, getattr(args, service + "_user"))
+    tracks = read_tracks(args.source, args.playlist, auths.get(args.source), args.use_async)
+    pending = convert.pending(tracks, args.target)
+    remaining = pending if args.fresh else convert.remaining(tracks, args.target)
+    reporter.emit("read", tracks=len(tracks), pending=len(pending), remaining=len(remaining))
+    if args.target == "youtube":
+        needed = quota.estimate_conversion(len(remaining))
+        if args.name: needed += quota.estimate_export(len(tracks))
+        quota.budget.check(needed)
+    with metrics.job("headless"):
+        convert.convert_tracks(tracks, args.target, auths[args.target], reporter.progress, resume=not args.fresh)
+    missing = [str(track) for track in tracks if track.services[args.target]['id'] == None]
+    reporter.emit("converted", tracks=len(tracks), found=len(tracks) - len(missing), missing=missing)
+    if args.name:
+        write = args.target + "_write_playlist"
+        if args.use_async:
+            playlist_id = load_asyncapi().run(write, auths[args.target], args.name, args.description, tracks, not args.private)
+        else:
+            playlist_id = getattr(apicontrol, write)(auths[args.target], args.name, args.description, tracks, not args.private)
+        reporter.emit("playlist", service=args.target, id=playlist_id, name=args.name)
+    if args.save:
+        save_tracks(args.save, tracks)
+        reporter.emit("saved", file=playlist_file, name=args.save)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(json.dumps([track.to_dict() for track in tracks], indent=4))
+        reporter.emit("saved", file=args.output)
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv == None else argv)
+    reporter = Reporter(sys.stdout)
+    # The conversion code prints as it goes, which would break up the JSON lines, so it is sent to stderr instead
+    with contextlib.redirect_stdout(sys.stderr):
+        reporter.emit("start", source=args.source, playlist=args.playlist, target=args.target)
+        try:
+            run(args, reporter)
+        except youtube.QuotaError as e:
+            reporter.emit("error", type="quota", message=str(e), needed=e.needed, remaining=e.remaining)
+            return EXIT_QUOTA
+        except Error as e:
+            reporter.emit("error", type="usage", message=str(e))
+            return EXIT_ERROR
+        except Exception as e:
+            traceback.print_exc()
+            reporter.emit("error", type=type(e).__name__, message=str(e))
+            return EXIT_ERROR
+        reporter.emit("done")
+    return 0
+
+if __name__ == "__main__": sys.exit(main())
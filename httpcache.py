@@ -0,0 +1,192 @@
+import os, re, json, time, hashlib, threading, atexit, requests
+from urllib.parse import urlencode
+from requests.structures import CaseInsensitiveDict
+
+CACHE_DIR = "data/http_cache"
+CACHE_MAX_BYTES = 50 * 1024 * 1024  # Total size of the stored bodies before the least recently used are removed
+INDEX_SAVE_DELAY = 10               # Least amount of seconds between saves of the index
+
+# How long a cached response can be used without asking the API again, per endpoint. The first matching pattern is used.
+# A TTL of 0 means the response is stored but always revalidated with If-None-Match / If-Modified-Since, which costs
+# one round trip but no download (and less quota on Google APIs). Urls that match nothing are never cached,
+# which keeps per-user listings such as /me/playlists and mine=true out of the cache
+ENDPOINT_TTLS = [
+    (r"^https://api\.spotify\.com/v1/tracks/", 7 * 24 * 60 * 60),
+    (r"^https://api\.spotify\.com/v1/albums", 7 * 24 * 60 * 60),
+    (r"^https://api\.spotify\.com/v1/artists/", 24 * 60 * 60),
+    (r"^https://api\.spotify\.com/v1/playlists/", 0),
+    (r"^https://www\.googleapis\.com/youtube/v3/videos\?", 24 * 60 * 60),
+    (r"^https://www\.googleapis\.com/youtube/v3/playlists\?(?!.*mine=true)", 0),
+    (r"^https://www\.googleapis\.com/youtube/v3/playlistItems\?", 0),
+]
+
+# A response stored in the cache
+class Entry:
+    def __init__(self, meta, body):
+        self.meta = meta
+        self.body = body
+
+    # True if the entry can be used without revalidating it
+    def fresh(self):
+        return time.time() - self.meta['stored'] < self.meta['ttl']
+
+    # The conditional request headers for revalidating this entry
+    def validators(self):
+        headers = {}
+        if self.meta.get('etag'):
+            headers['If-None-Match'] = self.meta['etag']
+        if self.meta.get('modified'):
+            headers['If-Modified-Since'] = self.meta['modified']
+        return headers
+
+    # Rebuilds a requests.Response, so callers can't tell a cached response from a downloaded one
+    def response(self):
+        r = requests.Response()
+        r.status_code = 200
+        r.url = self.meta['url']
+        r._content = self.body
+        r.encoding = "utf-8"
+        r.headers = CaseInsensitiveDict({"content-type": self.meta.get('type') or "application/json"})
+        return r
+
+# An on-disk cache of GET responses, keyed by url and parameters, evicted least recently used first.
+# The index is loaded on first use, so nothing is read or written until a cacheable request is made
+class ResponseCache:
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, ttls=ENDPOINT_TTLS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in ttls]
+        self.index = None
+        self.dirty = False
+        self.saved = 0
+        self.lock = threading.RLock()
+
+    def ttl(self, url):
+        for pattern, ttl in self.ttls:
+            if pattern.search(url):
+                return ttl
+        return None
+
+    # Returns the cache key for a request, or None if the request shouldn't be cached
+    def key(self, url, params=None):
+        if self.ttl(url) == None:
+            return None
+        if params:
+            url += "#" + urlencode(sorted(params.items()))
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    def body_file(self, key):
+        return os.path.join(self.directory, key + ".body")
+
+    def index_file(self):
+        return os.path.join(self.directory, "index.json")
+
+    def load(self):
+        if self.index == None:
+            try:
+                with open(self.index_file()) as f:
+                    self.index = json.loads(f.read())
+            except (OSError, ValueError):
+                self.index = {}
+
+    def save(self):
+        if not os.path.isdir(self.directory): os.makedirs(self.directory)
+        temp = self.index_file() + ".tmp"
+        with open(temp, "w") as f:
+            f.write(json.dumps(self.index))
+        os.replace(temp, self.index_file())
+        self.dirty = False
+        self.saved = time.time()
+
+    # Notes that the index has changed. It's saved at most every INDEX_SAVE_DELAY seconds, as rewriting the whole index
+    # on every request would hold up every thread on the lock, and flush saves the rest at exit. If the app is killed
+    # first, responses stored since the last save are downloaded again, and get drops entries whose body was evicted
+    def changed(self):
+        self.dirty = True
+        if time.time() - self.saved > INDEX_SAVE_DELAY:
+            self.save()
+
+    # Returns the stored Entry for key, or None
+    def get(self, key):
+        with self.lock:
+            self.load()
+            meta = self.index.get(key)
+            if meta == None:
+                return None
+            try:
+                with open(self.body_file(key), "rb") as f:
+                    body = f.read()
+            except OSError:
+                self.index.pop(key)
+                return None
+            meta['used'] = time.time()
+            self.changed()
+            return Entry(meta, body)
+
+    # Stores a successful response
+    def put(self, key, url, response):
+        etag = response.headers.get("ETag")
+        modified = response.headers.get("Last-Modified")
+        ttl = self.ttl(url)
+        if ttl == 0 and not etag and not modified: # Can never be revalidated, so there's no point keeping it
+            return
+        with self.lock:
+            self.load()
+            if not os.path.isdir(self.directory): os.makedirs(self.directory)
+            with open(self.body_file(key), "wb") as f:
+                f.write(response.content)
+            now = time.time()
+            self.index[key] = {
+                "url": url,
+                "etag": etag,
+                "modified": modified,
+                "type": response.headers.get("content-type"),
+                "ttl": ttl,
+                "stored": now,
+                "used": now,
+                "size": len(response.content)
+            }
+            self.evict()
+            self.changed()
+
+    # Marks an entry as valid again after the API returned 304 Not Modified
+    def revalidated(self, key):
+        with self.lock:
+            self.load()
+            if key in self.index:
+                self.index[key]['stored'] = time.time()
+                self.dirty = True
+
+    # Removes the least recently used entries until the cache is under max_bytes
+    def evict(self):
+        total = sum(meta['size'] for meta in self.index.values())
+        for key in sorted(self.index, key=lambda key: self.index[key]['used']):
+            if total <= self.max_bytes:
+                break
+            total -= self.index.pop(key)['size']
+            try:
+                os.remove(self.body_file(key))
+            except OSError:
+                pass
+
+    # Deletes every stored response
+    def clear(self):
+        with self.lock:
+            self.load()
+            for key in self.index:
+                try:
+                    os.remove(self.body_file(key))
+                except OSError:
+                    pass
+            self.index = {}
+            self.save()
+
+    # Writes any unsaved changes to the index
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                self.save()
+
+# The cache used by apicontrol.makeRequest
+cache = ResponseCache()
+atexit.register(cache.flush)
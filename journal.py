@@ -0,0 +1,59 @@
+import os, json, time, hashlib, threading
+import apicontrol
+
+JOBS_DIR = "data/jobs"
+JOURNAL_TTL = 7 * 24 * 60 * 60 # Journals untouched for this many seconds are from abandoned jobs, and are ignored
+
+# Identifies a conversion by its service and the playlist it converts, so starting the same conversion again, e.g.
+# after the app closed or the quota ran out, finds the journal it left behind. Every track is part of the key, not
+# only the pending ones, as the tracks an interrupted run converted are no longer pending once put in the table
+def job_id(service, tracks):
+    key = [service] + [[track.title, track.artist, track.album] for track in tracks]
+    return service + "-" + hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+
+# An append-only record of the tracks a conversion job has finished, one JSON line per track under JOBS_DIR.
+# Each line is written as soon as the track finishes, so nothing already paid for is lost if the job stops early
+class Journal:
+    def __init__(self, job_id, directory=JOBS_DIR):
+        self.directory = directory
+        self.filename = os.path.join(directory, job_id + ".jsonl")
+        self.lock = threading.Lock()
+
+    # Returns {index: track or None} for every track finished so far. None means the track was searched for but not found
+    def load(self):
+        finished = {}
+        try:
+            if time.time() - os.path.getmtime(self.filename) > JOURNAL_TTL:
+                self.remove()
+                return finished
+            with open(self.filename) as f:
+                lines = f.readlines()
+        except OSError:
+            return finished
+        if lines and not lines[-1].endswith("\n"): # Cut short by the app closing mid-write, and would run into the next line
+            lines = lines[:-1]
+            with self.lock, open(self.filename, "w") as f:
+                f.writelines(lines)
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            finished[entry['index']] = None if entry['track'] == None else apicontrol.track_from_dict(entry['track'])
+        return finished
+
+    # Records the outcome of the track at index
+    def record(self, index, track):
+        line = json.dumps({"index": index, "track": None if track == None else track.to_dict()})
+        with self.lock:
+            if not os.path.isdir(self.directory): os.makedirs(self.directory)
+            with open(self.filename, "a") as f:
+                f.write(line + "\n")
+
+    # Deletes the journal once the job is finished
+    def remove(self):
+        with self.lock:
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
@@ -0,0 +1,56 @@
+import os, json, threading
+
+# A dictionary kept in a JSON file under data/. The file is only read on first use and written on every change,
+# through a temporary file so a crash mid-write can't leave it half written. Safe to share between threads
+class JsonStore:
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = None
+        self.lock = threading.RLock()
+
+    def load(self):
+        if self.data == None:
+            try:
+                with open(self.filename) as f:
+                    self.data = json.loads(f.read())
+            except (OSError, ValueError):
+                self.data = {}
+        return self.data
+
+    def save(self):
+        head, tail = os.path.split(self.filename)
+        if head and not os.path.isdir(head): os.makedirs(head)
+        temp = self.filename + ".tmp"
+        with open(temp, "w") as f:
+            f.write(json.dumps(self.data))
+        os.replace(temp, self.filename)
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.load().get(key, default)
+
+    def set(self, key, value):
+        with self.lock:
+            self.load()[key] = value
+            self.save()
+
+    # Sets several keys at once, saving the file a single time
+    def update(self, values):
+        with self.lock:
+            self.load().update(values)
+            self.save()
+
+    def pop(self, key, default=None):
+        with self.lock:
+            value = self.load().pop(key, default)
+            self.save()
+            return value
+
+    def keys(self):
+        with self.lock:
+            return list(self.load().keys())
+
+    def clear(self):
+        with self.lock:
+            self.data = {}
+            self.save()
@@ -1,10 +1,8 @@
-import sys, traceback, copy, json, os, random, string, isodate, webbrowser
-import apicontrol, search, spotify, youtube
+import sys, traceback, copy, json, os, random, string, webbrowser
+import apicontrol, search, searchcache, convert, spotify, youtube, oauth, connection, metrics, quota
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
-from PyQt5.QtWebEngineWidgets import *
 from PyQt5.QtGui import *
-from mutagen.mp3 import EasyMP3
 
 # todo - search for item done/cancel buttons resizing correctly
 # todo - Fetch progress bar working correctly - skipping stuff correctly
@@ -61,6 +59,8 @@ class WorkerSignals(QObject):
     error = pyqtSignal(tuple)
     result = pyqtSignal(object)
     progress = pyqtSignal(int)
+    partial = pyqtSignal(object)
+    completed = pyqtSignal(int)
 
 # Worker object. Runs the specified function with the specified arguments in the threadpool
 class Worker(QRunnable):
@@ -76,7 +76,8 @@ class Worker(QRunnable):
     @pyqtSlot()
     def run(self):
         try:
-            result = self.fn(*self.args, **self.kwargs)
+            with metrics.job(self.fn.__name__): # Requests made by this worker are counted under the function's name
+                result = self.fn(*self.args, **self.kwargs)
         except:
             traceback.print_exc()
             exctype, value = sys.exc_info()[:2]
@@ -86,6 +87,27 @@ class Worker(QRunnable):
         finally:
             self.signals.finished.emit() # Done
 
+# Worker object for functions that return a generator of lists. Each list is emitted through the partial signal as
+# soon as it is yielded and isn't kept, so only one batch is held at a time. Once the generator is finished the
+# completed signal gets the amount of items that were emitted
+class StreamWorker(Worker):
+    @pyqtSlot()
+    def run(self):
+        try:
+            count = 0
+            with metrics.job(self.fn.__name__):
+                for batch in self.fn(*self.args, **self.kwargs):
+                    count += len(batch)
+                    self.signals.partial.emit(batch)
+        except:
+            traceback.print_exc()
+            exctype, value = sys.exc_info()[:2]
+            self.signals.error.emit((exctype, value, traceback.format_exc()))
+        else:
+            self.signals.completed.emit(count)
+        finally:
+            self.signals.finished.emit()
+
 # Generates a busy QProgress bar
 def generateBar(button):
     bar = QProgressBar()
@@ -114,6 +136,9 @@ class MainWindow(QWidget):
         self.updateAuths(self.spotifyUsername, self.youtubeUsername)
         self.threadpool = QThreadPool()
         self.threadpool.setMaxThreadCount(MAX_THREADS)
+        # Enough keep-alive connections per host for every thread to be paging through a playlist at once, or for a
+        # conversion, whose tracks can each be paging through an album, if that's more
+        connection.set_pool_size(max(self.threadpool.maxThreadCount() * apicontrol.PAGINATION_THREADS, apicontrol.YOUTUBE_INSERT_THREADS, convert.max_connections()))
         self.initUI()
         print("Multithreading with maximum %d threads" % self.threadpool.maxThreadCount())
 
@@ -236,6 +261,9 @@ class MainWindow(QWidget):
         managePlaylistsAction = accountsMenu.addAction("Manage &Playlists")
         wipeLoginsAction = accountsMenu.addAction("&Wipe Accounts")
 
+        debugMenu = menuBar.addMenu("&Debug")
+        requestMetricsAction = debugMenu.addAction("Request &Metrics")
+
         #debugAction = menuBar.addAction("Debug")
         #debugAction.triggered.connect(lambda: importLocalButton.setFixedWidth(spotifyFetchStack.width()))
         #debugAction.setEnabled(False)
@@ -312,6 +340,7 @@ class MainWindow(QWidget):
         tableReorderAction.triggered.connect(self.openReorderDialog)
         managePlaylistsAction.triggered.connect(self.openManagePlaylistDialog)
         addSearchTrackAction.triggered.connect(self.openTrackSearchDialog)
+        requestMetricsAction.triggered.connect(self.openMetricsDialog)
         undoAction.triggered.connect(self.undo)
         redoAction.triggered.connect(self.redo)
 
@@ -429,20 +458,26 @@ class MainWindow(QWidget):
         self.loadButton.setFixedWidth(self.importSpotifyStack.width())
         self.saveButton.setFixedWidth(self.exportSpotifyStack.width())
 
-    # Updates sAuth and yAuth to tokens created using the specified usernames s and y
+    # Updates sAuth and yAuth to the shared tokens of the specified usernames s and y. Tokens are only refreshed if they are about to expire
     def updateAuths(self, s, y, **kwargs):
         spotifyToken = None
         youtubeToken = None
         if self.spotifyUsername in [x['username'] for x in spotify.token(spotify_scope, request=True).auths]:
-            spotifyToken = spotify.token(spotify_scope, s)
+            spotifyToken = spotify.shared_token(spotify_scope, s)
             self.settings.setValue("logins/spotify", s)
         else:
             self.settings.setValue("logins/spotify", None)
         if self.youtubeUsername in [x['username'] for x in youtube.token(youtube_scope, request=True).auths]:
-            youtubeToken = youtube.token(youtube_scope, y)
+            youtubeToken = youtube.shared_token(youtube_scope, y)
             self.settings.setValue("logins/youtube", y)
         else:
             self.settings.setValue("logins/youtube", None)
+        # Accounts switched away from stop refreshing in the background. Anything still using their token object can,
+        # as it refreshes itself when it's used after expiring
+        if self.sAuth != None and self.sAuth is not spotifyToken:
+            oauth.forget("spotify", self.sAuth.username)
+        if self.yAuth != None and self.yAuth is not youtubeToken:
+            oauth.forget("youtube", self.yAuth.username)
         self.sAuth, self.yAuth = spotifyToken, youtubeToken
 
     # Thread wrapper for updateAuths
@@ -591,8 +626,9 @@ class MainWindow(QWidget):
         f.write(json.dumps(playlists))
         f.close()
 
-    # Reads the specified MP3 file, returning a track object
+    # Reads the specified MP3 file, returning a track object. mutagen is only imported when the first file is read
     def readLocalMP3(self, filename):
+        from mutagen.mp3 import EasyMP3
         mp3 = EasyMP3(filename)
         try:
             title = mp3.tags['title'][0]
@@ -667,6 +703,12 @@ class MainWindow(QWidget):
             else:
                 return
         tracks = self.tracks
+        if service == "youtube":
+            try:
+                quota.budget.check(quota.estimate_export(len([x for x in tracks if x.services['youtube']['id']])))
+            except youtube.QuotaError as e:
+                self.showErrorMessage(customText=str(e), customTitle="Not Enough YouTube Quota")
+                return
         if service == "spotify":
             self.exportSpotifyStack.setCurrentIndex(1)
             worker = Worker(self.exportSpotify, name, desc, tracks, public, replace)
@@ -701,11 +743,12 @@ class MainWindow(QWidget):
         return playlist_id
 
     # Thread wrapper for importing tracks
+    # When a playlist_id is given, the tracks are streamed into the table a page at a time as they arrive
     def initImportThread(self, service, fetchStack, playlist_id=None, album=False):
         if service == "spotify":
             if playlist_id:
-                worker = Worker(self.importSpotify, playlist_id, album)
-                worker.signals.result.connect(lambda result: self.updateTable(self.table, result, append=True))
+                worker = StreamWorker(self.streamSpotify, playlist_id, album)
+                self.connectStreamWorker(worker)
             else:
                 worker = Worker(self.importSpotify)
                 worker.signals.result.connect(lambda result: self.openPlaylistDialog(result, service))
@@ -713,8 +756,8 @@ class MainWindow(QWidget):
             worker.signals.error.connect(self.showErrorMessage)
         elif service == "youtube":
             if playlist_id:
-                worker = Worker(self.importYoutube, playlist_id)
-                worker.signals.result.connect(lambda result: self.updateTable(self.table, result, append=True))
+                worker = StreamWorker(self.streamYoutube, playlist_id)
+                self.connectStreamWorker(worker)
             else:
                 worker = Worker(self.importYoutube)
                 worker.signals.result.connect(lambda result: self.openPlaylistDialog(result, service))
@@ -750,6 +793,28 @@ class MainWindow(QWidget):
             playlists = apicontrol.youtube_read_playlists(self.yAuth, ids=True)
             return playlists
 
+    # Streams the tracks of a spotify playlist or album, for StreamWorker
+    def streamSpotify(self, playlist_id, album=False, *args, **kwargs):
+        return apicontrol.spotify_iter_playlist(self.sAuth, playlist_id, album)
+
+    # Streams the tracks of a youtube playlist, for StreamWorker
+    def streamYoutube(self, playlist_id, *args, **kwargs):
+        return apicontrol.youtube_iter_playlist(self.yAuth, playlist_id)
+
+    # Appends each batch from a StreamWorker to the table as it arrives.
+    # Only the first batch adds an undo step, so undo removes the whole import at once
+    def connectStreamWorker(self, worker):
+        started = []
+        def appendBatch(batch):
+            self.updateTable(self.table, batch, append=True, record=not started)
+            started.append(True)
+        worker.signals.partial.connect(appendBatch)
+        worker.signals.completed.connect(lambda count: self.recordLastAction())
+
+    # Sets the redo action to restore the table as it is now
+    def recordLastAction(self):
+        self.lastAction = lambda self=self, tracks=copy.deepcopy(self.tracks): self.updateTable(self.table, tracks, False)
+
     # Opens the playlist dialog to pick a playlist, then updates the table with the chosen playlist
     def openPlaylistDialog(self, playlists, service):
         dialog = ImportPlaylistDialog(playlists)
@@ -784,17 +849,25 @@ class MainWindow(QWidget):
             worker.signals.finished.connect(self.updateRequirementButtons)
             worker.signals.result.connect(self.updateTableThreadWrapper)
             if displayProgress: worker.signals.progress.connect(self.spotifyFetchBar.setValue)
+            worker.signals.error.connect(self.partialUpdateWrapper)
             worker.signals.error.connect(self.showErrorMessage)
         elif service == "youtube":
             if self.yAuth == None:
                 self.showErrorMessage(customText="Logged out of YouTube")
                 return
+            toConvert = convert.remaining(tracks, "youtube", selected) # Tracks finished by a run that ran out of quota aren't counted again
+            try:
+                quota.budget.check(quota.estimate_conversion(len(toConvert)))
+            except youtube.QuotaError as e:
+                self.showErrorMessage(customText=str(e), customTitle="Not Enough YouTube Quota")
+                return
             worker = Worker(self.updateYoutube, tracks, selected=selected)
             worker.signals.finished.connect(self.thread_complete)
             worker.signals.finished.connect(lambda: self.fetchLockWrapper(False))
             worker.signals.finished.connect(self.updateRequirementButtons)
             worker.signals.result.connect(self.updateTableThreadWrapper)
             if displayProgress: worker.signals.progress.connect(self.youtubeFetchBar.setValue)
+            worker.signals.error.connect(self.partialUpdateWrapper)
             worker.signals.error.connect(self.showErrorMessage)
         else:
             raise ValueError("Invalid service for initImportThread")
@@ -804,51 +877,23 @@ class MainWindow(QWidget):
         self.threadpool.start(worker)
         self.updateRequirementButtons()
 
+    # Puts the tracks converted before an update stopped early, e.g. when the YouTube quota ran out, into the table
+    def partialUpdateWrapper(self, error):
+        tracks = getattr(error[1], "tracks", None)
+        if tracks != None:
+            self.updateTable(self.table, tracks, False)
+
     # You cannot assign in a lambda function, so this function circumvents that
     def fetchLockWrapper(self, lock):
         self.fetchLock = lock
 
-    # Update a list of spotify tracks
+    # Update a list of spotify tracks. The tracks are converted several at a time by the convert module
     def updateSpotify(self, tracks, progressCallback, selected=None, *args, **kwargs):
-        progressCallback.emit(0)
-        for i, track in enumerate(tracks):
-            progressCallback.emit(round((i) / len(tracks) * 100))
-            if selected != None and not i in selected:
-                continue
-            if track.services['spotify']['id'] != None:
-                continue
-            try:
-                new_track = search.youtube_to_spotify(track, self.sAuth)
-            except Exception as e: # So the thread doesn't close when a single track errors
-                traceback.print_exc()
-                new_track = None
-            if new_track == None:
-                print(str(track) + " failed to update")
-            else:
-                print(str(track) + " updated")
-                tracks[i] = new_track
-        return tracks
+        return convert.convert_tracks(tracks, "spotify", self.sAuth, progressCallback.emit, selected)
 
     # Update a list of youtube tracks
     def updateYoutube(self, tracks, progressCallback, selected=None, *args, **kwargs):
-        progressCallback.emit(0)
-        for i, track in enumerate(tracks):
-            if selected != None and not i in selected:
-                continue
-            if track.services['youtube']['id'] != None:
-                continue
-            try:
-                new_track = search.spotify_to_youtube(track, self.yAuth)
-            except Exception as e: # So the thread doesn't close when a single track errors
-                traceback.print_exc()
-                new_track = None
-            if new_track == None:
-                print(str(track) + " failed to update")
-            else:
-                print(str(track) + " updated")
-                tracks[i] = new_track
-            progressCallback.emit(round((i + 1) / len(tracks) * 100))
-        return tracks
+        return convert.convert_tracks(tracks, "youtube", self.yAuth, progressCallback.emit, selected)
 
     # Deprecated. Makes the whole table open or closed for editing.
     def setTableEdit(self, edit):
@@ -885,11 +930,13 @@ class MainWindow(QWidget):
 
     # Updates the specified table with the specified tracks.
     # If append is True, append the specified tracks to the existing tracks in the table.
-    def updateTable(self, table, tracks, append=False):
+    # If record is False, no undo step is added (used for the later batches of a streamed import)
+    def updateTable(self, table, tracks, append=False, record=True):
         scrollPos = table.verticalScrollBar().value()
-        oldTracks = copy.deepcopy(self.tracks)
-        self.undoStack.append(lambda self=self, table=table, oldTracks=oldTracks: self.updateTable(table, oldTracks, append=False))
-        self.lastAction = lambda self=self, table=table, tracks=copy.deepcopy(tracks), append=append: self.updateTable(table, tracks, append)
+        if record:
+            oldTracks = copy.deepcopy(self.tracks)
+            self.undoStack.append(lambda self=self, table=table, oldTracks=oldTracks: self.updateTable(table, oldTracks, append=False))
+            self.lastAction = lambda self=self, table=table, tracks=copy.deepcopy(tracks), append=append: self.updateTable(table, tracks, append)
         if append:
             self.tracks += tracks
         else:
@@ -1052,6 +1099,11 @@ class MainWindow(QWidget):
                 else:
                     raise ValueError("Invalid service for TrackSearchDialog return")
 
+    # Opens the MetricsDialog
+    def openMetricsDialog(self):
+        dialog = MetricsDialog()
+        dialog.exec_()
+
 # Dialog to search for tracks by name
 class TrackSearchDialog(QDialog):
     def __init__(self, sAuth, yAuth, threadpool):
@@ -1391,7 +1443,7 @@ class TrackSearchDialog(QDialog):
                         None
                     )
                     track.update_service("youtube", data['id'])
-                    track.update_duration("youtube", isodate.parse_duration(data['contentDetails']['duration']).total_seconds())
+                    track.update_duration("youtube", apicontrol.parse_duration(data['contentDetails']['duration']))
                     results.append(track)
             for matched_id in matched_ids['playlists']:
                 data = apicontrol.youtube_get_playlist_info(self.yAuth, matched_id)
@@ -1412,7 +1464,7 @@ class TrackSearchDialog(QDialog):
                         None
                     )
                     track.update_service("youtube", data['id'])
-                    track.update_duration("youtube", isodate.parse_duration(data['contentDetails']['duration']).total_seconds())
+                    track.update_duration("youtube", apicontrol.parse_duration(data['contentDetails']['duration']))
                     results.append(track)
                 elif resultType == "multiple":
                     if searchType == "playlist":
@@ -1437,6 +1489,68 @@ class TrackSearchDialog(QDialog):
         self.result = result
         self.accept()
 
+# Debug dialog showing the request statistics collected by the metrics module, with JSON and Prometheus exports
+class MetricsDialog(QDialog):
+    def __init__(self):
+        super().__init__()
+        self.initUI()
+
+    # Main function for creating the UI
+    def initUI(self):
+        textEdit = QTextEdit()
+        textEdit.setReadOnly(True)
+        textEdit.setLineWrapMode(QTextEdit.NoWrap)
+        textEdit.setMinimumWidth(SEARCH_TABLE_FIXED_WIDTH)
+        textEdit.setMinimumHeight(SEARCH_TABLE_FIXED_HEIGHT)
+
+        refreshButton = QPushButton("Refresh")
+        exportJsonButton = QPushButton("Export JSON")
+        exportPrometheusButton = QPushButton("Export Prometheus")
+        resetButton = QPushButton("Reset")
+        doneButton = QPushButton("Done")
+        doneButton.setDefault(True)
+
+        buttonHBox = QHBoxLayout()
+        buttonHBox.addWidget(refreshButton)
+        buttonHBox.addWidget(exportJsonButton)
+        buttonHBox.addWidget(exportPrometheusButton)
+        buttonHBox.addWidget(resetButton)
+        buttonHBox.addStretch(1)
+        buttonHBox.addWidget(doneButton)
+
+        mainVBox = QVBoxLayout()
+        mainVBox.addWidget(textEdit)
+        mainVBox.addLayout(buttonHBox)
+
+        refreshButton.clicked.connect(self.refresh)
+        exportJsonButton.clicked.connect(lambda: self.export(metrics.registry.to_json(), "*.json"))
+        exportPrometheusButton.clicked.connect(lambda: self.export(metrics.registry.to_prometheus(), "*.prom"))
+        resetButton.clicked.connect(self.reset)
+        doneButton.clicked.connect(self.accept)
+
+        self.textEdit = textEdit
+
+        self.refresh()
+        self.setLayout(mainVBox)
+        self.setWindowModality(Qt.ApplicationModal)
+        self.setWindowTitle("Request Metrics")
+        self.show()
+
+    # Shows the current snapshot, followed by the search cache's hit and miss counts
+    def refresh(self):
+        self.textEdit.setPlainText(metrics.registry.to_json() + "\n\nSearch cache\n" + json.dumps(searchcache.cache.stats(), indent=4))
+
+    def reset(self):
+        metrics.registry.reset()
+        self.refresh()
+
+    # Saves text to a file picked with a QFileDialog
+    def export(self, text, nameFilter):
+        filename, selectedFilter = QFileDialog.getSaveFileName(self, "Export Metrics", "", nameFilter)
+        if filename:
+            with open(filename, "w") as f:
+                f.write(text)
+
 # Dialog to reorder the tracks loaded in the central table
 class ReorderDialog(QDialog):
     def __init__(self, tracks):
@@ -1875,7 +1989,9 @@ class ImportPlaylistDialog(QDialog):
 
 # Dialog for opening a browser. Specify a URL to start at with startUrl.
 # The dialog will quit when the current URL has quitUrl CONTAINED within it. E.g. specifying "localhost?code="
-# in quitUrl will get the browser to quit when an auth code is returned
+# in quitUrl will get the browser to quit when an auth code is returned.
+# QtWebEngine starts Chromium when it's imported, so it is only imported the first time a BrowserDialog opens. This
+# needs Qt.AA_ShareOpenGLContexts to have been set before the QApplication was created, which main does
 class BrowserDialog(QDialog):
     def __init__(self, startUrl, quitUrl = None):
         super().__init__()
@@ -1892,6 +2008,7 @@ class BrowserDialog(QDialog):
         urlBar.setSizePolicy(QSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding))
         urlBar.setReadOnly(True)
 
+        from PyQt5.QtWebEngineWidgets import QWebEngineView
         browser = QWebEngineView()
         browser.resize(1200,800)
 
@@ -2123,6 +2240,7 @@ class MenuWrapper(QMainWindow):
 # Main function. Initialises Qt
 def main():
     sys.excepthook = except_hook
+    QCoreApplication.setAttribute(Qt.AA_ShareOpenGLContexts) # Lets BrowserDialog import QtWebEngine after the app starts
     app = QApplication(sys.argv)
     win = MenuWrapper()
     sys.exit(app.exec_())
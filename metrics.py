@@ -0,0 +1,196 @@
+import threading, time, json, re, contextlib
+from urllib.parse import urlsplit
+
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10] # Upper bounds, in seconds, of the latency histogram buckets
+PROMETHEUS_PREFIX = "musicconverter"
+
+# Path segments that look like Spotify/YouTube ids are replaced, so /v1/albums/4aawyAB9vmqN3uQ7FjRGTy/tracks
+# is counted as /v1/albums/{id}/tracks
+ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{16,}$")
+# The numbering of a thread's name, e.g. pagination_3 or Dummy-12, which is left out so threads are counted by pool
+THREAD_NUMBER = re.compile(r"[-_]\d+.*$")
+
+_local = threading.local()
+
+# Turns a request into the name it is counted under
+def endpoint(method, url):
+    parts = urlsplit(url)
+    path = "/".join("{id}" if ID_PATTERN.match(segment) else segment for segment in parts.path.split("/"))
+    return method.upper() + " " + parts.netloc + path
+
+# Labels every request made by the current thread inside the with block as part of the named job
+@contextlib.contextmanager
+def job(name):
+    previous = getattr(_local, "job", None)
+    _local.job = name
+    try:
+        yield
+    finally:
+        _local.job = previous
+
+def current_job():
+    return getattr(_local, "job", None) or "none"
+
+# Wraps fn so it runs under the current thread's job in whichever thread calls it, as pool threads don't inherit it
+def carry_job(fn):
+    name = current_job()
+    def run(*args, **kwargs):
+        with job(name):
+            return fn(*args, **kwargs)
+    return run
+
+# The name requests from the current thread are counted under. Pools like pagination's are created for every call,
+# and Qt's pool replaces idle threads, so counting by full thread name would add new stats for as long as the app runs
+def thread_label():
+    return THREAD_NUMBER.sub("", threading.current_thread().name) or "unnamed"
+
+# Counters for one endpoint, thread pool and job
+class Stats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0          # Requests that never got a response
+        self.bytes = 0
+        self.retries = 0
+        self.throttled = 0       # 429s, and Google's rate limit 403s
+        self.server_errors = 0   # 5XXs
+        self.coalesced = 0       # Requests answered by another thread's identical request, so never sent
+        self.reauthorized = 0    # 401s replayed with a refreshed access token
+        self.latency_sum = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1) # The last bucket is +Inf
+
+    def add(self, other):
+        self.calls += other.calls
+        self.errors += other.errors
+        self.bytes += other.bytes
+        self.retries += other.retries
+        self.throttled += other.throttled
+        self.server_errors += other.server_errors
+        self.coalesced += other.coalesced
+        self.reauthorized += other.reauthorized
+        self.latency_sum += other.latency_sum
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "bytes": self.bytes,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "server_errors": self.server_errors,
+            "coalesced": self.coalesced,
+            "reauthorized": self.reauthorized,
+            "latency_sum": round(self.latency_sum, 6),
+            "latency_buckets": dict(zip([str(x) for x in LATENCY_BUCKETS] + ["+Inf"], self.buckets))
+        }
+
+# Collects request statistics from every thread. Stats are kept per (endpoint, thread pool, job) and added up when exported
+class Registry:
+    def __init__(self):
+        self.stats = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def _stats(self, method, url):
+        key = (endpoint(method, url), thread_label(), current_job())
+        stats = self.stats.get(key)
+        if stats == None:
+            stats = self.stats[key] = Stats()
+        return stats
+
+    # Records a finished request. status is None if no response was received
+    def request(self, method, url, seconds, status=None, size=0):
+        with self.lock:
+            stats = self._stats(method, url)
+            stats.calls += 1
+            stats.bytes += size
+            stats.latency_sum += seconds
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stats.buckets[i] += 1
+                    break
+            else:
+                stats.buckets[-1] += 1
+            if status == None:
+                stats.errors += 1
+
+    def retry(self, method, url):
+        with self.lock:
+            self._stats(method, url).retries += 1
+
+    def throttle(self, method, url):
+        with self.lock:
+            self._stats(method, url).throttled += 1
+
+    def server_error(self, method, url):
+        with self.lock:
+            self._stats(method, url).server_errors += 1
+
+    def coalesced(self, method, url):
+        with self.lock:
+            self._stats(method, url).coalesced += 1
+
+    def reauthorized(self, method, url):
+        with self.lock:
+            self._stats(method, url).reauthorized += 1
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+            self.started = time.time()
+
+    # Adds up the stats by endpoint, thread and job, returning a JSON serialisable dict
+    def snapshot(self):
+        with self.lock:
+            items = list(self.stats.items())
+        groups = {"endpoints": {}, "threads": {}, "jobs": {}}
+        for (name, thread, job_name), stats in items:
+            for group, key in (("endpoints", name), ("threads", thread), ("jobs", job_name)):
+                groups[group].setdefault(key, Stats()).add(stats)
+        snapshot = {"since": self.started, "time": time.time()}
+        for group in groups:
+            ordered = sorted(groups[group].items(), key=lambda item: -item[1].calls) # Busiest first
+            snapshot[group] = {key: stats.to_dict() for key, stats in ordered}
+        return snapshot
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=4)
+
+    # Exports the stats in the Prometheus text format, labelled with endpoint, thread and job
+    def to_prometheus(self):
+        with self.lock:
+            items = list(self.stats.items())
+        counters = [
+            ("requests_total", "Requests sent", "calls"),
+            ("request_errors_total", "Requests that got no response", "errors"),
+            ("response_bytes_total", "Bytes received", "bytes"),
+            ("retries_total", "Requests retried after an error", "retries"),
+            ("throttled_total", "Rate limited responses", "throttled"),
+            ("server_errors_total", "5XX responses", "server_errors"),
+            ("coalesced_total", "Requests that shared another thread's identical request", "coalesced"),
+            ("reauthorized_total", "401 responses replayed with a refreshed access token", "reauthorized"),
+        ]
+        lines = []
+        for name, help_text, attribute in counters:
+            lines.append("# HELP {}_{} {}".format(PROMETHEUS_PREFIX, name, help_text))
+            lines.append("# TYPE {}_{} counter".format(PROMETHEUS_PREFIX, name))
+            for key, stats in items:
+                lines.append("{}_{}{{{}}} {}".format(PROMETHEUS_PREFIX, name, labels(key), getattr(stats, attribute)))
+        name = PROMETHEUS_PREFIX + "_request_seconds"
+        lines.append("# HELP {} Request latency".format(name))
+        lines.append("# TYPE {} histogram".format(name))
+        for key, stats in items:
+            total = 0
+            for bound, count in zip([str(x) for x in LATENCY_BUCKETS] + ["+Inf"], stats.buckets):
+                total += count
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels(key), bound, total))
+            lines.append("{}_sum{{{}}} {}".format(name, labels(key), round(stats.latency_sum, 6)))
+            lines.append("{}_count{{{}}} {}".format(name, labels(key), stats.calls))
+        return "\n".join(lines) + "\n"
+
+def labels(key):
+    values = [str(x).replace("\\", "\\\\").replace('"', '\\"') for x in key]
+    return 'endpoint="{}",thread="{}",job="{}"'.format(*values)
+
+# The registry shared by connection, apicontrol and the GUI
+registry = Registry()
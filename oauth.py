@@ -0,0 +1,139 @@
+import os, json, threading, time, traceback
+
+REFRESH_MARGIN = 5 * 60      # Access tokens are refreshed this many seconds before they expire
+DEFAULT_EXPIRES_IN = 60 * 60 # Spotify and Google both issue hour long access tokens
+
+# Returns when a token response will expire, as a unix time, adding it to the response so it's saved with the token
+def stamp_expiry(tokens):
+    tokens['expires_at'] = time.time() + tokens.get('expires_in', DEFAULT_EXPIRES_IN)
+    return tokens['expires_at']
+
+class ExpiringToken:
+    """
+    Base class for spotify.token and youtube.token that keeps track of when the access token expires.
+    Reading the token attribute returns the current access token, refreshing it first if it has expired or is about to.
+    Tokens handed out by shared_token are also refreshed in the background by a timer, REFRESH_MARGIN seconds before
+    they expire, so requests rarely wait.
+    Refreshes are done under a lock, so when several threads find the token expired only one of them refreshes it.
+
+    Subclasses call init_expiry before setting the token, set expires_at whenever they get a new access token, and
+    implement refresh_token.
+
+    Attributes:
+        access_token: The access token, without refreshing it
+        expires_at: The unix time the access token expires at
+    """
+    def init_expiry(self):
+        self.access_token = None
+        self.expires_at = 0
+        self.refresh_lock = threading.Lock()
+        self.timer = None
+
+    @property
+    def token(self):
+        if self.access_token != None and not self.valid():
+            self.ensure_fresh()
+        return self.access_token
+
+    @token.setter
+    def token(self, value):
+        self.access_token = value
+
+    # True if the access token won't expire within REFRESH_MARGIN seconds
+    def valid(self):
+        return self.access_token != None and self.expires_at - time.time() > REFRESH_MARGIN
+
+    # Refreshes the access token if it is about to expire, unless another thread refreshed it while this one waited.
+    # stale is an access token the API rejected with a 401, which is refreshed even though it looks valid, but only
+    # if it's still the current one, so many requests failing at once cause a single refresh
+    def ensure_fresh(self, stale=None):
+        with self.refresh_lock:
+            if (stale != None and self.access_token == stale) or not self.valid():
+                self.refresh_token()
+                if self.timer != None: self.schedule_refresh() # Only shared tokens have a timer
+        return self.access_token
+
+    # Starts a timer to refresh the token REFRESH_MARGIN seconds before it expires, replacing any earlier timer
+    def schedule_refresh(self):
+        if self.timer != None: self.timer.cancel()
+        self.timer = threading.Timer(max(0, self.expires_at - time.time() - REFRESH_MARGIN), self.background_refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def background_refresh(self):
+        try:
+            self.ensure_fresh()
+        except Exception as e: # The next request will try again
+            traceback.print_exc()
+
+    # Stops refreshing in the background, e.g. when the account is removed
+    def stop(self):
+        with self.refresh_lock:
+            if self.timer != None: self.timer.cancel()
+            self.timer = None
+
+shared = {}
+shared_locks = {}
+shared_lock = threading.Lock()
+
+# Returns the one token object for a service, scope and username, creating it the first time, so every thread uses
+# (and refreshes) the same token. cls is spotify.token or youtube.token.
+# Creating a token can mean refreshing it, so it's done under a lock for that key alone: only threads asking for the
+# same account wait for it
+def shared_token(service, cls, scope, username):
+    key = (service, " ".join(sorted(scope.split())), username)
+    with shared_lock:
+        token = shared.get(key)
+        if token != None:
+            return token
+        key_lock = shared_locks.setdefault(key, threading.Lock())
+    with key_lock:
+        with shared_lock:
+            token = shared.get(key) # Another thread may have created it while this one waited
+        if token == None:
+            token = cls(scope, username)
+            if token.access_token != None: token.schedule_refresh()
+            with shared_lock:
+                shared[key] = token
+        return token
+
+# Drops the shared tokens of a service, or only those of one username
+def forget(service, username=None):
+    with shared_lock:
+        tokens = [shared.pop(key) for key in list(shared) if key[0] == service and (username == None or key[2] == username)]
+    for token in tokens: # Outside the lock, as stop waits for any refresh in progress
+        token.stop()
+
+file_locks = {}
+file_locks_lock = threading.Lock()
+
+# Returns the lock for an auth file. Every change to an auth file is made under it, on a fresh read of the file, so
+# token objects never write an old copy of the file over each other's changes
+def file_lock(filename):
+    with file_locks_lock:
+        return file_locks.setdefault(os.path.abspath(filename), threading.Lock())
+
+# Reads the saved tokens in filename, passes them to change, and saves the list it returns. Returns the saved list
+def update_saved(filename, change):
+    with file_lock(filename):
+        with open(filename) as f:
+            auths = json.loads(f.read() or "[]")
+        auths = change(auths)
+        with open(filename, "w") as f:
+            f.write(json.dumps(auths))
+        return auths
+
+# Saves the tokens from a refresh in place of the account's earlier ones, found by username and refresh token, which
+# stay the same across refreshes. Nothing is added if the account isn't saved, as it has been deleted since
+def replace_saved(filename, tokens):
+    def change(auths):
+        kept = []
+        replaced = False
+        for auth in auths:
+            if auth['username'] == tokens['username'] and auth.get('refresh_token') == tokens['refresh_token']:
+                if not replaced: kept.append(tokens) # Older copies of the same account are dropped
+                replaced = True
+            else:
+                kept.append(auth)
+        return kept
+    return update_saved(filename, change)
@@ -0,0 +1,87 @@
+import threading, datetime, math
+import jsonstore, youtube
+from urllib.parse import urlsplit
+
+QUOTA_FILE = "data/youtube_quota.json"
+DAILY_BUDGET = 10000     # Units available per day. The YouTube Data API default is 10,000
+RESET_UTC_OFFSET = -8    # The quota resets at midnight Pacific Time. Daylight saving is ignored, so it may be an hour off
+
+# Units charged for each YouTube Data API call, by method and resource
+# https://developers.google.com/youtube/v3/determine_quota_cost
+COSTS = {
+    ("get", "search"): 100,
+    ("get", "videos"): 1,
+    ("get", "playlists"): 1,
+    ("get", "playlistItems"): 1,
+    ("get", "channels"): 1,
+    ("post", "playlists"): 50,
+    ("put", "playlists"): 50,
+    ("delete", "playlists"): 50,
+    ("post", "playlistItems"): 50,
+    ("put", "playlistItems"): 50,
+    ("delete", "playlistItems"): 50,
+}
+DEFAULT_COST = 1
+EXPORT_REPAIR_SHARE = 0.1 # Share of an export's inserts kept in reserve for retries and reordering
+
+# Returns the quota cost of a request. Requests that aren't to the YouTube Data API are free
+def cost(method, url):
+    parts = urlsplit(url)
+    if parts.netloc != "www.googleapis.com" or not parts.path.startswith("/youtube/v3/"):
+        return 0
+    resource = parts.path[len("/youtube/v3/"):].strip("/")
+    return COSTS.get((method.lower(), resource), DEFAULT_COST)
+
+# Quota needed to convert tracks to YouTube with search.spotify_to_youtube: a search and one duration lookup per track.
+# convert_tracks pools the lookups of several tracks into one call, so this is an upper bound
+def estimate_conversion(tracks):
+    return tracks * (COSTS[("get", "search")] + COSTS[("get", "videos")])
+
+# Quota needed for apicontrol.youtube_write_playlist: the playlist, an insert per video, reading it back twice to check
+# it, and EXPORT_REPAIR_SHARE of the videos again for retrying inserts that failed and moving ones that landed out of order
+def estimate_export(videos):
+    repairs = math.ceil(videos * EXPORT_REPAIR_SHARE) * max(COSTS[("post", "playlistItems")], COSTS[("put", "playlistItems")])
+    reads = 2 * max(1, math.ceil(videos / 50)) * COSTS[("get", "playlistItems")]
+    return COSTS[("post", "playlists")] + videos * COSTS[("post", "playlistItems")] + repairs + reads
+
+# Keeps track of the units spent today, saved under data/ so it carries over between runs
+class QuotaBudget:
+    def __init__(self, filename=QUOTA_FILE, budget=DAILY_BUDGET):
+        self.store = jsonstore.JsonStore(filename)
+        self.budget = budget
+        self.lock = threading.Lock()
+
+    def today(self):
+        return datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=RESET_UTC_OFFSET))).date().isoformat()
+
+    def spent(self):
+        if self.store.get("day") != self.today():
+            return 0
+        return self.store.get("spent", 0)
+
+    def remaining(self):
+        return max(0, self.budget - self.spent())
+
+    def can_afford(self, units):
+        return units <= self.remaining()
+
+    # Raises youtube.QuotaError if a job needing units can't be finished today
+    def check(self, units):
+        remaining = self.remaining()
+        if units > remaining:
+            raise youtube.QuotaError(units, remaining)
+
+    # Records a request about to be sent, refusing it if it would go over the budget
+    def charge(self, method, url):
+        units = cost(method, url)
+        if units == 0:
+            return 0
+        with self.lock:
+            spent = self.spent()
+            if spent + units > self.budget:
+                raise youtube.QuotaError(units, self.budget - spent)
+            self.store.update({"day": self.today(), "spent": spent + units})
+        return units
+
+# The budget shared by apicontrol and search
+budget = QuotaBudget()
@@ -0,0 +1,118 @@
+import threading, time, random, email.utils
+from urllib.parse import urlsplit
+
+# Requests per second allowed for each API host before we start pacing, and how many can be sent in a burst.
+# These are kept a little under what each service tolerates, and are lowered automatically when a 429 is received
+HOST_RATES = {
+    "api.spotify.com": (10, 10),
+    "accounts.spotify.com": (5, 5),
+    "www.googleapis.com": (20, 20),
+}
+DEFAULT_RATE = (10, 10)
+MIN_RATE = 0.5           # The lowest a host's rate will be lowered to after repeated 429s
+RATE_DECREASE = 0.5      # Multiplier applied to a host's rate on a 429
+RATE_INCREASE = 0.1      # Requests per second added back to a host's rate for each successful request
+BACKOFF_MAX = 30         # Upper bound, in seconds, for a single backoff sleep
+
+# A token bucket for a single host. Each request takes a token. Tokens refill at self.rate per second up to self.capacity.
+# Tokens can go negative, which reserves a slot in the future, so concurrent threads are spaced out rather than
+# all waking up at the same moment
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Takes a token, returning how long the caller has to wait before sending its request
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            delay = 0
+            if self.tokens < 0:
+                delay = -self.tokens / self.rate
+            return max(delay, self.blocked_until - now)
+
+    # Stops every request to this host for the specified amount of seconds, and slows the rate down
+    def pause(self, seconds):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.blocked_until = max(self.blocked_until, now + seconds)
+            self.rate = max(MIN_RATE, self.rate * RATE_DECREASE)
+            self.tokens = min(self.tokens, 0)
+
+    # Slowly raises the rate back up after it was lowered by pause
+    def recover(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + RATE_INCREASE)
+
+# Holds one TokenBucket per API host. A single instance is shared by every thread, so when one thread
+# is told to back off, all of them do
+class RateLimiter:
+    def __init__(self, rates=None):
+        self.rates = HOST_RATES if rates == None else rates
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket == None:
+                rate, capacity = self.rates.get(host, DEFAULT_RATE)
+                bucket = TokenBucket(rate, capacity)
+                self.buckets[host] = bucket
+            return bucket
+
+    # Returns how long to wait before a request to url can be sent, without sleeping. For callers that sleep themselves
+    def delay(self, url):
+        return self.bucket(url).reserve()
+
+    # Blocks until a request to url can be sent
+    def wait(self, url):
+        delay = self.delay(url)
+        if delay > 0:
+            time.sleep(delay)
+
+    # Called when a host responds with 429 (or a rate limit 403). Honours Retry-After, using default if it is missing
+    def throttled(self, url, response, default):
+        seconds = retry_after(response, default)
+        self.bucket(url).pause(seconds)
+        return seconds
+
+    # Called when a request to url succeeded
+    def succeeded(self, url):
+        self.bucket(url).recover()
+
+# Reads the Retry-After header from a response, which is either a number of seconds or a HTTP date
+def retry_after(response, default):
+    value = response.headers.get("Retry-After")
+    if value == None:
+        return default
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    return max(0, date.timestamp() - time.time())
+
+# Exponential backoff with full jitter, so threads that failed together don't retry together
+def backoff(attempt, base):
+    return random.uniform(0, min(BACKOFF_MAX, base * 2 ** attempt))
+
+# The limiter shared by all of apicontrol
+limiter = RateLimiter()
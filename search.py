@@ -1,126 +1,310 @@
-import itertools, apicontrol, json, traceback, isodate
+import apicontrol, catalog, searchcache, youtube, json, traceback, re, threading, contextlib
+from collections import OrderedDict
 from urllib.parse import quote
 
-# Creates a list of all possible combinations of string of words
-# https://stackoverflow.com/questions/464864/how-to-get-all-possible-combinations-of-a-list-s-elements
-# I edited this function to remove the empty tuple and the full tuple
-def powerset(iterable):
-    s = list(iterable)
-    pow = itertools.chain.from_iterable(itertools.combinations(s, r) for r in range(len(s)+1))
-    pow = (x for x in pow if x != () and x != s)
-    return pow
-
-# Converts a tuple of strings to a single string, seperated by spaces
-def tuple_to_str(terms):
-    str_terms = []
-    for x in terms:
-        if type(x) != tuple and type(x) != list and type(x) != set:
-            str_terms.append(x)
-            continue
-        new_str = ""
-        for y in x:
-            new_str += y + " "
-        str_terms.append(new_str[:-1])
-    return str_terms
-
-# Runs a search through spotify's api
-def spotify_search(keywords, content_type, auth, amount=1):
+MAX_SEARCH_REQUESTS = 6  # Hard limit on how many spotify searches youtube_to_spotify makes for a single track
+MAX_ARTIST_CRAWLS = 2    # How many artist discographies youtube_to_spotify will look through for a single track
+TRACK_RESULTS = 5        # How many results each track search returns to check
+VIDEO_RESULTS = 5        # How many results spotify_to_youtube checks the duration of for each track
+VIDEO_IDS_CHUNKS = 50    # How many videos' durations are looked up at once (YouTube's maximum)
+ALBUM_IDS_CHUNKS = 20    # How many albums are fetched at once from the several albums endpoint (Spotify's maximum)
+ALBUM_GROUPS = ["album", "single", "compilation", "appears_on"] # The order an artist's releases are looked through in
+INDEX_CACHE_SIZE = 16    # How many artists' TitleIndexes are kept, so converting several songs by one artist reuses them
+
+# Bracketed parts of YouTube titles that aren't part of the song name, e.g. (Official Video), [HD], (Lyrics)
+TITLE_NOISE = re.compile(r"\s*[\(\[][^\)\]]*\b(official|video|audio|lyrics?|hd|hq|4k|visuali[sz]er|remaster(ed)?|explicit|m/?v)\b[^\)\]]*[\)\]]", re.IGNORECASE)
+FEATURING = re.compile(r"\s+[\(\[]?(feat\.?|ft\.?|featuring)\s.*$", re.IGNORECASE)
+# Suffixes of YouTube channel names that aren't part of the artist name, e.g. "Artist - Topic", "ArtistVEVO"
+CHANNEL_NOISE = re.compile(r"(\s*-\s*topic|\s*vevo|\s+official)$", re.IGNORECASE)
+TITLE_SEPARATOR = re.compile(r"\s+[-\u2013\u2014]\s+")
+
+# Removes the parts of a YouTube title that won't be in the Spotify track name
+def clean_title(title):
+    title = TITLE_NOISE.sub("", title)
+    title = FEATURING.sub("", title)
+    return " ".join(title.replace('"', "").split())
+
+# Removes the parts of a YouTube channel name that won't be in the Spotify artist name
+def clean_artist(channel):
+    return " ".join(CHANNEL_NOISE.sub("", channel).split())
+
+# Lowercases and removes punctuation, for comparing names loosely
+def normalise(text):
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+# Splits a YouTube title in the form "Artist - Title" into (artist, title). Returns None if there is no separator
+def split_title(title):
+    parts = TITLE_SEPARATOR.split(clean_title(title), maxsplit=1)
+    if len(parts) == 2 and parts[0] and parts[1]:
+        return parts[0], clean_title(parts[1])
+    return None
+
+# Works out a short, ranked list of searches to try for a YouTube track. Each is a (kind, query) tuple, where kind is
+# "track" for a track search whose results are checked directly, or "artist" for an artist search followed by looking
+# through that artist's discography. The most specific searches come first, so most tracks are matched by the first one
+def plan_queries(track):
+    channel = clean_artist(track.artist)
+    title = clean_title(track.title)
+    queries = []
+    split = split_title(track.title)
+    if split:
+        artist, name = split
+        queries.append(("track", 'track:"' + name + '" artist:"' + artist + '"'))
+    queries.append(("track", 'track:"' + title + '" artist:"' + channel + '"'))
+    if split:
+        queries.append(("track", artist + " " + name))
+    else:
+        queries.append(("track", channel + " " + title))
+    queries.append(("track", title))
+    if split:
+        queries.append(("artist", artist))
+    queries.append(("artist", channel))
+    planned = []
+    for query in queries: # Remove duplicates, keeping the first
+        if query[1].strip() and not query in planned:
+            planned.append(query)
+    return planned
+
+# Runs a search through spotify's api. Results are reused from searchcache unless cached is False
+def spotify_search(keywords, content_type, auth, amount=1, cached=True):
     valid_types = ["artist","album","track","playlist"]
     if not content_type in valid_types: raise ValueError("Invalid Type - "+content_type)
-    headers = {"Authorization":"Bearer "+auth.token}
-    keywords = quote(keywords)
-    r = apicontrol.makeRequest("https://api.spotify.com/v1/search?q=" + keywords + "&type=" + content_type + "&limit=" + str(amount), "get", headers=headers)
+    if cached:
+        data = searchcache.cache.get("spotify", content_type, keywords, amount)
+        if data != None: return data
+    r = apicontrol.makeRequest("https://api.spotify.com/v1/search?q=" + quote(keywords) + "&type=" + content_type + "&limit=" + str(amount), "get", auth=auth)
     data = json.loads(r.text)[content_type+"s"]['items']
-    if len(data) == 0:
-        return []
-    else:
-        return data
+    searchcache.cache.put("spotify", content_type, keywords, amount, data)
+    return data
 
-# Runs a search through YouTube's api. offset specifies the result number to return, default 0 (the first result)
-def youtube_search(keywords, content_type, auth, amount=1):
+# Runs a search through YouTube's api. Each search costs 100 quota units, so results are reused from searchcache
+# unless cached is False
+def youtube_search(keywords, content_type, auth, amount=1, cached=True):
     valid_types = ["video","channel","playlist"]
     if not content_type in valid_types: raise ValueError("Invalid Type - " + content_type)
-    headers = {"Authorization": "Bearer " + auth.token}
-    keywords = quote(keywords)
-    r = apicontrol.makeRequest("https://www.googleapis.com/youtube/v3/search?q=" + keywords + "&part=snippet&maxResults=" + str(amount) + "&type=" + content_type, "get", headers=headers)
+    if cached:
+        data = searchcache.cache.get("youtube", content_type, keywords, amount)
+        if data != None: return data
+    r = apicontrol.makeRequest("https://www.googleapis.com/youtube/v3/search?q=" + quote(keywords) + "&part=snippet&maxResults=" + str(amount) + "&type=" + content_type, "get", auth=auth)
     data = json.loads(r.text)['items']
+    searchcache.cache.put("youtube", content_type, keywords, amount, data)
     return data
 
-# Runs through a list of tracks until it hits one that is in youtube_str
+# An Aho-Corasick automaton over the lowercased titles of a list of tracks, so a YouTube title can be checked against
+# every track in a single pass over the title, however many tracks there are. Build one per catalog and reuse it.
+# A track matches if its title appears in the YouTube title as a full word (WIN doesn't match ElectrosWINg), and
+# the longest matching title wins, with ties going to the track that was added first
+class TitleIndex:
+    def __init__(self, tracks=()):
+        self.tracks = []
+        self.children = [{}]     # Per state, the next state for each character
+        self.depth = [0]         # Per state, the length of the text it stands for
+        self.ends = [None]       # Per state, the number of the first track whose title ends there
+        self.fail = [0]          # Per state, the longest proper suffix of its text that is also a state
+        self.output = [[]]       # Per state, (title length, track number) of every title that ends there or in a suffix
+        self.built = True
+        self.add(tracks)
+
+    # Adds more tracks to the index. The failure links are rebuilt on the next match
+    def add(self, tracks):
+        for track in tracks:
+            title = track.title.lower()
+            self.tracks.append(track)
+            if title == "":
+                continue
+            state = 0
+            for char in title:
+                next_state = self.children[state].get(char)
+                if next_state == None:
+                    next_state = len(self.children)
+                    self.children[state][char] = next_state
+                    self.children.append({})
+                    self.depth.append(self.depth[state] + 1)
+                    self.ends.append(None)
+                    self.fail.append(0)
+                    self.output.append([])
+                state = next_state
+            if self.ends[state] == None: # A track with the same title as an earlier one can never be the match
+                self.ends[state] = len(self.tracks) - 1
+            self.built = False
+
+    # Fills in the failure links breadth first, so each state's outputs include those of its failure state
+    def build(self):
+        queue = [0]
+        for state in queue:
+            for char, child in self.children[state].items():
+                fallback = self.fail[state]
+                while fallback and not char in self.children[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.children[fallback].get(char, 0) if state else 0
+                own = [] if self.ends[child] == None else [(self.depth[child], self.ends[child])]
+                self.output[child] = own + self.output[self.fail[child]]
+                queue.append(child)
+        self.built = True
+
+    # Returns the track matching a YouTube title, or None
+    def match(self, youtube_str):
+        if not self.built: self.build()
+        text = youtube_str.lower()
+        best = None
+        state = 0
+        for i, char in enumerate(text):
+            while state and not char in self.children[state]:
+                state = self.fail[state]
+            state = self.children[state].get(char, 0)
+            for length, number in self.output[state]:
+                start = i - length + 1
+                # Only full words count, so the characters either side of the match can't be letters
+                if start > 0 and text[start - 1].isalpha(): continue
+                if i + 1 < len(text) and text[i + 1].isalpha(): continue
+                if best == None or length > best[0] or (length == best[0] and number < best[1]):
+                    best = (length, number)
+        if best == None:
+            return None
+        return self.tracks[best[1]]
+
+    # Matches a list of YouTube titles, e.g. a whole playlist, returning a track or None for each
+    def match_all(self, youtube_strs):
+        return [self.match(youtube_str) for youtube_str in youtube_strs]
+
+    def __len__(self):
+        return len(self.tracks)
+
+artist_indexes = OrderedDict()
+artist_indexes_lock = threading.Lock()
+
+# Returns a TitleIndex of an artist's saved tracks, reusing the last one built for the artist if they haven't changed.
+# Saved discographies only ever grow until they expire, so the length and last track are enough to tell
+def artist_index(artist_id, tracks):
+    key = (len(tracks), tracks[-1].services['spotify']['id'] if tracks else None)
+    with artist_indexes_lock:
+        cached = artist_indexes.get(artist_id)
+        if cached != None and cached[0] == key:
+            artist_indexes.move_to_end(artist_id)
+            return cached[1]
+    index = TitleIndex(tracks)
+    with artist_indexes_lock:
+        artist_indexes[artist_id] = (key, index)
+        artist_indexes.move_to_end(artist_id)
+        while len(artist_indexes) > INDEX_CACHE_SIZE:
+            artist_indexes.popitem(last=False)
+    return index
+
+# Returns the track whose title is in youtube_str as a full word, preferring the longest. spotify_tracks can be a
+# list of tracks or a TitleIndex; pass an index when matching several titles against the same tracks
 def match_tracks(youtube_str, spotify_tracks):
-    matching_tracks = []
-    for track in spotify_tracks:
-        trackTitle = track.title.lower()
-        youtubeTitle = youtube_str.lower()
-        if trackTitle in youtubeTitle:
-            # We need to check if the match is not just a substring, to reduce incorrect matches.
-            # E.g. WIN in ElectrosWINg throws the algorithm into an incorrect artist that makes it match
-            # incorrectly. The below code checks to see if the values either side of the match are
-            # not letters to make sure it is a full word
-            start = youtubeTitle.index(trackTitle)
-            end = start + len(trackTitle)
-            if start > 0:
-                startCheck = not youtubeTitle[start-1].isalpha()
-            else:
-                startCheck = True
-            try:
-                endCheck = not youtubeTitle[end].isalpha()
-            except IndexError:
-                endCheck = True
-            # ---
-            if startCheck and endCheck:
-                matching_tracks.append(track)
-    if len(matching_tracks) == 0:
-        return None
-    elif len(matching_tracks) == 1:
-        return matching_tracks[0]
-    max_len = 0
-    matched_track = None
-    for track in matching_tracks: # If there are multiple matching tracks, return the longest match
-        if len(track.title) > max_len:
-            max_len = len(track.title)
-            matched_track = track
-    return matched_track
+    if not isinstance(spotify_tracks, TitleIndex):
+        spotify_tracks = TitleIndex(spotify_tracks)
+    return spotify_tracks.match(youtube_str)
 
 # Returns all tracks from a specified artists id
 def spotify_all_tracks(artist_id, auth):
     all_tracks = []
-    headers = {"Authorization":"Bearer "+auth.token}
-    albums = apicontrol.pagination("https://api.spotify.com/v1/artists/" + artist_id + "/albums", "get", headers=headers)
-    for album in albums:
-        tracks = apicontrol.pagination("https://api.spotify.com/v1/albums/" + album['id'] + "/tracks?limit=50", "get", headers=headers)
-        for track in tracks:
-            track_obj = apicontrol.Track(
-                    track['name'],
-                    track['artists'][0]['name'],
-                    album['name']
-                )
-            track_obj.update_service("spotify",track['id'])
-            track_obj.update_duration("spotify", track['duration_ms']/1000) # Convert ms to s
-            all_tracks.append(track_obj)
+    for tracks in spotify_iter_tracks(artist_id, auth):
+        all_tracks += tracks
     return all_tracks
 
+# A generator of lists of tracks by an artist, one list per album, so matching can stop as soon as the track is found.
+# Albums are looked through in the order of ALBUM_GROUPS, most likely to have the track first.
+# Discographies are saved by the catalog module, so each artist is only crawled once every catalog.CATALOG_TTL
+# seconds however many tracks are converted. Saved tracks are yielded first, in a single list
+def spotify_iter_tracks(artist_id, auth, groups=None):
+    if groups == None: groups = ALBUM_GROUPS
+    return catalog.cache.iter_tracks(artist_id, lambda skip: spotify_crawl_tracks(artist_id, auth, groups, skip))
+
+# Fetches the tracks of an artist from the spotify api, yielding (album_id, tracks) for each album that isn't in skip.
+# Albums are fetched ALBUM_IDS_CHUNKS at a time from the several albums endpoint, which includes the first page of
+# each album's tracks, so only albums with more tracks than that need their own requests
+def spotify_crawl_tracks(artist_id, auth, groups, skip=()):
+    for group in groups:
+        for albums in apicontrol.iter_pagination("https://api.spotify.com/v1/artists/" + artist_id + "/albums?limit=50&include_groups=" + group, "get", auth=auth):
+            album_ids = [album['id'] for album in albums if not album['id'] in skip]
+            for i in range(0, len(album_ids), ALBUM_IDS_CHUNKS):
+                r = apicontrol.makeRequest("https://api.spotify.com/v1/albums?ids=" + ",".join(album_ids[i:i + ALBUM_IDS_CHUNKS]), "get", auth=auth)
+                for album in json.loads(r.content)['albums']:
+                    if album == None: # Albums that can't be found are returned as null
+                        continue
+                    yield album['id'], spotify_album_tracks(album, auth)
+
+# Returns the tracks of a full album object, fetching the rest of the tracks if they didn't all fit in the album object
+def spotify_album_tracks(album, auth):
+    tracks = album['tracks']['items']
+    if album['tracks']['next']:
+        tracks = tracks + apicontrol.pagination(album['tracks']['next'], "get", auth=auth)
+    album_tracks = []
+    for track in tracks:
+        track_obj = apicontrol.Track(
+                track['name'],
+                track['artists'][0]['name'],
+                album['name']
+            )
+        track_obj.update_service("spotify",track['id'])
+        track_obj.update_duration("spotify", track['duration_ms']/1000) # Convert ms to s
+        album_tracks.append(track_obj)
+    return album_tracks
+
+# Converts a track object returned by the spotify api into a track object
+def spotify_track_from_result(result):
+    track = apicontrol.Track(
+        result['name'],
+        result['artists'][0]['name'],
+        result['album']['name']
+    )
+    track.update_service("spotify", result['id'])
+    track.update_duration("spotify", result['duration_ms'] / 1000)
+    return track
+
+# Returns the first track from a list of spotify track search results that is confidently the youtube track:
+# the track name is a full word match in the youtube title, and its artist is named in the title or the channel
+def confident_match(track, results):
+    candidates = [spotify_track_from_result(result) for result in results]
+    youtubeText = normalise(track.title + " " + track.artist)
+    while candidates:
+        matched = match_tracks(track.title, candidates)
+        if matched == None:
+            return None
+        if " " + normalise(matched.artist) + " " in " " + youtubeText + " ":
+            return matched
+        candidates.remove(matched)
+    return None
+
 # Searching in Spotify is a total pain, as you have to specify the keywords exactly or it will return nothing.
-# The algorithm this uses is outlines in search_notes.txt
+# The searches from plan_queries are tried in order until one gives a confident match.
+# At most MAX_SEARCH_REQUESTS searches and MAX_ARTIST_CRAWLS discographies are used per track, however long the title is
 def youtube_to_spotify(track, auth):
-    search_terms = [track.artist]
-    if len(track.artist.split(" ")) > 0:
-        search_terms += tuple_to_str(powerset(track.artist.split(" ")))
-    if len(track.title.split(" ")) > 0:
-        search_terms += tuple_to_str(powerset(track.title.split(" ")))
-    for term in search_terms:
-        try:
-            artist = spotify_search(term,"artist", auth, amount=1)[0]
-        except IndexError:
+    searches = 0
+    crawls = 0
+    crawled = set()
+    for kind, query in plan_queries(track):
+        if searches >= MAX_SEARCH_REQUESTS:
+            break
+        if kind == "artist" and crawls >= MAX_ARTIST_CRAWLS:
             continue
+        searches += 1
+        try:
+            if kind == "track":
+                matched_track = confident_match(track, spotify_search(query, "track", auth, amount=TRACK_RESULTS))
+            else:
+                artists = spotify_search(query, "artist", auth, amount=1)
+                if not artists or artists[0]['id'] in crawled:
+                    continue
+                crawls += 1
+                crawled.add(artists[0]['id'])
+                matched_track = None
+                albums = spotify_iter_tracks(artists[0]['id'], auth)
+                try:
+                    for i, tracks in enumerate(albums): # Stop crawling as soon as the track is found
+                        # The first list is usually the saved discography, whose index is kept between tracks
+                        index = artist_index(artists[0]['id'], tracks) if i == 0 else TitleIndex(tracks)
+                        matched_track = index.match(track.title)
+                        if matched_track != None:
+                            break
+                finally:
+                    albums.close() # Saves what was crawled so far, and lets other threads use this artist
         except Exception as e:
-            print("Error with search term '" + term + "'")
+            print("Error with search term '" + query + "'")
             traceback.print_exc() # If the search raises an ApiError or something, we want to just move onto the next term, not give up completly
-            artist = None
-        if artist == None: # No artist returned, continue to next serach term
             continue
-        tracks = spotify_all_tracks(artist['id'],auth)
-        matched_track = match_tracks(track.title, tracks)
         if matched_track != None: # A track has been matched, add the spotify link to the original track and return it.
             track.title = matched_track.title # Spotify is the most reliable, update all values to the matched track
             track.artist = matched_track.artist
@@ -129,21 +313,113 @@ def youtube_to_spotify(track, auth):
             return track
     return None
 
-# Searching using YouTube is much simpler, as Google (believe it or not) is good at searching
-def spotify_to_youtube(track, auth):
-    search_term = track.artist + " " + track.title
-    results = youtube_search(search_term, "video", auth, 5)
+# Searching using YouTube is much simpler, as Google (believe it or not) is good at searching.
+# durations is an optional dict of video id to duration, shared between calls so no video is looked up twice
+def spotify_to_youtube(track, auth, durations=None):
+    results = youtube_candidates(track, auth)
+    durations = youtube_durations([result['id']['videoId'] for result in results], auth, durations)
+    return choose_video(track, results, durations)
+
+# The search results spotify_to_youtube picks a video from
+def youtube_candidates(track, auth):
+    return youtube_search(track.artist + " " + track.title, "video", auth, VIDEO_RESULTS)
+
+# Looks up the durations, in seconds, of a list of video ids, VIDEO_IDS_CHUNKS at a time, adding them to durations.
+# Ids already in durations aren't looked up again, and videos that no longer exist are left out
+def youtube_durations(ids, auth, durations=None):
+    if durations == None: durations = {}
+    missing = []
+    for id in ids:
+        if not id in durations and not id in missing:
+            missing.append(id)
+    for i in range(0, len(missing), VIDEO_IDS_CHUNKS):
+        r = apicontrol.makeRequest("https://www.googleapis.com/youtube/v3/videos?part=contentDetails&maxResults=50&id=" + ",".join(missing[i:i + VIDEO_IDS_CHUNKS]), auth=auth)
+        for item in json.loads(r.text)['items']:
+            duration = item['contentDetails']['duration'] # get the ISO 8601 duration string
+            durations[item['id']] = apicontrol.parse_duration(duration) # parse into seconds
+    return durations
+
+# Pools the duration lookups of every track a conversion has in flight into shared videos.list calls, so a playlist
+# costs about one videos request per VIDEO_IDS_CHUNKS search results instead of one per track.
+# Each track searches inside searching(), then calls lookup with its results' ids, which waits until they have been
+# looked up. A call is sent once VIDEO_IDS_CHUNKS ids are waiting, or sooner if no track is still searching, as
+# nothing else would be added to it. Durations are kept in durations, so no video is looked up twice
+class DurationPool:
+    def __init__(self, auth, durations=None):
+        self.auth = auth
+        self.durations = {} if durations == None else durations
+        self.pending = []     # Ids waiting for a call
+        self.requested = set() # Ids that are pending, being looked up or done
+        self.done = set()
+        self.failed = {}      # Id to the error its call raised
+        self.searching = 0    # Tracks inside searching() that haven't called lookup yet
+        self.local = threading.local()
+        self.condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def searching_track(self):
+        with self.condition:
+            self.searching += 1
+        self.local.waiting = False
+        try:
+            yield
+        finally:
+            if not self.local.waiting: # The track ended without a lookup, e.g. its search errored
+                with self.condition:
+                    self.searching -= 1
+                    self.condition.notify_all()
+
+    # Returns the durations dict once every id in ids has been looked up. Raises the error of the call that
+    # looked any of them up, if it failed
+    def lookup(self, ids):
+        with self.condition:
+            self.local.waiting = True
+            self.searching -= 1
+            for id in ids:
+                if not id in self.requested and not id in self.durations:
+                    self.requested.add(id)
+                    self.pending.append(id)
+            while not all(id in self.done or id in self.durations for id in ids):
+                if self.pending and (len(self.pending) >= VIDEO_IDS_CHUNKS or self.searching == 0):
+                    self.flush()
+                else:
+                    self.condition.wait()
+            for id in ids:
+                if id in self.failed:
+                    raise self.failed[id]
+            return self.durations
+
+    # Looks up the next VIDEO_IDS_CHUNKS pending ids. Called with the condition held, which is let go during the request
+    def flush(self):
+        chunk = self.pending[:VIDEO_IDS_CHUNKS]
+        del self.pending[:VIDEO_IDS_CHUNKS]
+        found = {}
+        error = None
+        self.condition.release()
+        try:
+            youtube_durations(chunk, self.auth, found)
+        except Exception as e:
+            error = e
+        finally:
+            self.condition.acquire()
+        self.durations.update(found)
+        for id in chunk:
+            if error != None: self.failed[id] = error
+            self.done.add(id)
+        self.condition.notify_all()
+
+# Picks the first search result with a duration close enough to the track's other links, defaulting to the first
+# result, and adds it to the track. Returns None if there were no results
+def choose_video(track, results, durations):
     videoId = None
     firstDuration = None # Remember the first results duration to use later if none of the results match
     for result in results:
         id = result['id']['videoId']
-        headers = {
-            "authorization":"Bearer " + auth.token
-        }
-        r = apicontrol.makeRequest("https://www.googleapis.com/youtube/v3/videos?part=contentDetails&id="+id, headers=headers)
-        duration = json.loads(r.text)['items'][0]['contentDetails']['duration'] # get the ISO 8601 duration string
-        duration = isodate.parse_duration(duration).total_seconds() # parse into seconds
-        if not firstDuration: firstDuration = duration # Gets set on the first loop, but none of the others
+        duration = durations.get(id)
+        if duration == None:
+            print("Skipping " + id + " - video not found")
+            continue
+        if firstDuration == None: firstDuration = duration # Gets set on the first loop, but none of the others
         valid = track.update_duration("youtube", duration)
         if valid:
             videoId = id
@@ -157,4 +433,4 @@ def spotify_to_youtube(track, auth):
         print("No videos with a close enough duration were found. Defaulting to the first returned")
         track.update_service("youtube", results[0]['id']['videoId'])
         track.update_duration("youtube", firstDuration, force=True) # force=True, as the update_duration will fail, force the duration to update anyway
-    return track
\ No newline at end of file
+    return track
@@ -0,0 +1,173 @@
+import os, json, time, hashlib, threading, atexit
+from collections import OrderedDict
+
+CACHE_DIR = "data/search_cache"
+MEMORY_ENTRIES = 256     # Searches kept in memory, on top of the ones on disk
+DISK_ENTRIES = 5000      # Searches kept on disk before the least recently used are removed
+INDEX_SAVE_DELAY = 10    # Least amount of seconds between saves of the index
+
+# How long, in seconds, search results are used before searching again, by service and content type.
+# Catalogs rarely change, so tracks, albums and artists are kept longer than playlists and videos
+SEARCH_TTLS = {
+    ("spotify", "track"): 7 * 24 * 60 * 60,
+    ("spotify", "album"): 7 * 24 * 60 * 60,
+    ("spotify", "artist"): 7 * 24 * 60 * 60,
+    ("spotify", "playlist"): 24 * 60 * 60,
+    ("youtube", "video"): 3 * 24 * 60 * 60,
+    ("youtube", "channel"): 7 * 24 * 60 * 60,
+    ("youtube", "playlist"): 24 * 60 * 60,
+}
+DEFAULT_TTL = 24 * 60 * 60
+
+# Queries that only differ in case or spacing return the same results
+def normalise(keywords):
+    return " ".join(keywords.lower().split())
+
+# A cache of search results, keyed by service, content type and normalised query. Results are kept in a small
+# in-memory LRU in front of a larger one on disk, which is loaded on first use and shared between runs.
+# A search for fewer results than were stored is answered from the stored ones, so the amount isn't part of the key
+class SearchCache:
+    def __init__(self, directory=CACHE_DIR, memory_entries=MEMORY_ENTRIES, disk_entries=DISK_ENTRIES, ttls=SEARCH_TTLS):
+        self.directory = directory
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.ttls = ttls
+        self.memory = OrderedDict()
+        self.index = None
+        self.dirty = False
+        self.saved = 0
+        self.counts = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stored": 0, "evicted": 0}
+        self.lock = threading.RLock()
+
+    def ttl(self, service, content_type):
+        return self.ttls.get((service, content_type), DEFAULT_TTL)
+
+    def key(self, service, content_type, keywords):
+        return hashlib.sha1(json.dumps([service, content_type, normalise(keywords)]).encode("utf-8")).hexdigest()
+
+    def results_file(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def index_file(self):
+        return os.path.join(self.directory, "index.json")
+
+    def load(self):
+        if self.index == None:
+            try:
+                with open(self.index_file()) as f:
+                    self.index = json.loads(f.read())
+            except (OSError, ValueError):
+                self.index = {}
+
+    def save(self):
+        if not os.path.isdir(self.directory): os.makedirs(self.directory)
+        temp = self.index_file() + ".tmp"
+        with open(temp, "w") as f:
+            f.write(json.dumps(self.index))
+        os.replace(temp, self.index_file())
+        self.dirty = False
+        self.saved = time.time()
+
+    # Notes that the index has changed. It's saved at most every INDEX_SAVE_DELAY seconds rather than on every search,
+    # as it can hold DISK_ENTRIES searches, and flush saves the rest at exit
+    def changed(self):
+        self.dirty = True
+        if time.time() - self.saved > INDEX_SAVE_DELAY:
+            self.save()
+
+    def remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    # Returns the first amount stored results of a search, or None if it isn't stored, has expired, or has fewer results
+    def get(self, service, content_type, keywords, amount):
+        key = self.key(service, content_type, keywords)
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry != None and self.usable(entry, amount):
+                self.memory.move_to_end(key)
+                self.counts['memory_hits'] += 1
+                return entry['results'][:amount]
+            self.load()
+            meta = self.index.get(key)
+            if meta != None and self.usable(meta, amount):
+                try:
+                    with open(self.results_file(key)) as f:
+                        results = json.loads(f.read())
+                except (OSError, ValueError):
+                    self.index.pop(key)
+                    results = None
+                if results != None:
+                    meta['used'] = time.time()
+                    self.changed()
+                    self.remember(key, {"type": meta['type'], "amount": meta['amount'], "stored": meta['stored'], "results": results})
+                    self.counts['disk_hits'] += 1
+                    return results[:amount]
+            self.counts['misses'] += 1
+            return None
+
+    # True if a stored search hasn't expired and has enough results
+    def usable(self, entry, amount):
+        return entry['amount'] >= amount and time.time() - entry['stored'] < self.ttl(*entry['type'])
+
+    # Stores the results of a search for amount results
+    def put(self, service, content_type, keywords, amount, results):
+        key = self.key(service, content_type, keywords)
+        now = time.time()
+        with self.lock:
+            self.load()
+            if not os.path.isdir(self.directory): os.makedirs(self.directory)
+            with open(self.results_file(key), "w") as f:
+                f.write(json.dumps(results))
+            self.index[key] = {"type": [service, content_type], "amount": amount, "stored": now, "used": now}
+            self.remember(key, {"type": [service, content_type], "amount": amount, "stored": now, "results": results})
+            self.counts['stored'] += 1
+            self.evict()
+            self.changed()
+
+    # Removes the least recently used searches until there are at most disk_entries
+    def evict(self):
+        if len(self.index) <= self.disk_entries:
+            return
+        for key in sorted(self.index, key=lambda key: self.index[key]['used'])[:max(0, len(self.index) - self.disk_entries)]:
+            self.index.pop(key)
+            self.memory.pop(key, None)
+            self.counts['evicted'] += 1
+            try:
+                os.remove(self.results_file(key))
+            except OSError:
+                pass
+
+    # Hit and miss counts since the program started, plus how many searches are stored
+    def stats(self):
+        with self.lock:
+            self.load()
+            stats = dict(self.counts)
+            stats['memory_entries'] = len(self.memory)
+            stats['disk_entries'] = len(self.index)
+            return stats
+
+    # Deletes every stored search
+    def clear(self):
+        with self.lock:
+            self.load()
+            for key in self.index:
+                try:
+                    os.remove(self.results_file(key))
+                except OSError:
+                    pass
+            self.index = {}
+            self.memory = OrderedDict()
+            self.save()
+
+    # Writes any unsaved changes to the index
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                self.save()
+
+# The cache used by search.spotify_search and search.youtube_search
+cache = SearchCache()
+atexit.register(cache.flush)
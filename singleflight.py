@@ -0,0 +1,47 @@
+import threading
+
+# A call in progress. Threads asking for the same thing wait on it instead of making their own
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+# Runs at most one call per key at a time. A thread that asks for a key while another thread is already fetching it
+# waits for that call to finish and gets the same result, or the same exception, instead of repeating the work.
+# Nothing is kept once a call finishes, so this only merges calls that overlap; httpcache is for anything longer
+class Group:
+    def __init__(self):
+        self.calls = {}
+        self.shared = 0          # How many calls were answered by another thread's call
+        self.lock = threading.Lock()
+
+    # Returns fn(), or the result of the call for key already in progress. joined, if given, is called when this
+    # thread waits on another thread's call rather than running fn itself
+    def do(self, key, fn, joined=None):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call == None
+            if leader:
+                call = self.calls[key] = Call()
+            else:
+                self.shared += 1
+        if not leader:
+            if joined != None: joined()
+            call.done.wait()
+            if call.error != None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+# The group used by apicontrol.makeRequest
+group = Group()
@@ -1,23 +1,14 @@
-import requests, json, os
+import connection, config, oauth, json
 from urllib.parse import quote
 
-# Client credentials
+# Client credentials are read by the config module the first time they are needed, from api_creds.json or the environment
 # Make sure the redirect_uri has been whitelisted in your Spotify app's settings
-
-creds_file = "api_creds.json"
-with open(creds_file) as f:
-    data = json.loads(f.read())
-    client_id = data['spotify']['client_id']
-    client_secret = data['spotify']['client_secret']
-
 redirect_uri = "http://localhost/"
 auth_filename = "data/spotify_auth.json"
 
-head, tail = os.path.split(auth_filename)
-if head and not os.path.isdir(head): os.makedirs(head)
-if not os.path.isfile(auth_filename):
-    with open(auth_filename, "w") as f:
-        f.write("[]")
+# Returns auth_filename, creating it with no saved tokens the first time it's needed
+def auth_file():
+    return config.ensure_file(auth_filename, "[]")
 
 # All valid scopes allowed by Spotify
 valid_scopes = [
@@ -97,24 +88,16 @@ def wipe_cache():
     """
     Wipes auth.json, deleting any cached tokens. The user will need to log in again when creating a new token.
     """
-    f = open(auth_filename,"w")
-    f.write("[]")
-    f.close()
+    oauth.forget("spotify")
+    oauth.update_saved(auth_file(), lambda tokens: [])
 
 def delete_account(username):
     """
     Deletes all cached tokens with the specified username
     """
+    oauth.forget("spotify", username)
     print("Deleting " + username)
-    f = open(auth_filename, "r")
-    tokens = json.loads(f.read())
-    f.close()
-    for i, token in enumerate(tokens):
-        if token['username'] == username:
-            tokens.pop(i)
-    f = open(auth_filename, "w")
-    f.write(json.dumps(tokens))
-    f.close()
+    oauth.update_saved(auth_file(), lambda tokens: [token for token in tokens if token['username'] != username])
 
 def master_token(username):
     """
@@ -134,7 +117,14 @@ def master_token(username):
     scopeStr = scopeStr[:-1]
     return token(scopeStr, username)
 
-class token:
+def shared_token(scope, username):
+    """
+    Returns the token object for a saved account, creating it the first time. Every caller asking for the same scope
+    and username gets the same object, so the access token is only refreshed once for all of them.
+    """
+    return oauth.shared_token("spotify", token, scope, username)
+
+class token(oauth.ExpiringToken):
     """
     An class that handles the Spotify Web API authentication process, including user login and token refreshing.
     
@@ -147,8 +137,9 @@ class token:
 
     Attributes:
         scope: The all scopes of the token, as a string sperated by spaces
-        token: The access token that the user logged in with.
-        refresh: The refresh token. Spotify Web API tokens expire after an hour. Use the refresh_token function rather than manually refreshing the token.
+        token: The access token that the user logged in with. Refreshed first if it is about to expire.
+        expires_at: The unix time that the access token expires at.
+        refresh: The refresh token. Spotify Web API tokens expire after an hour. They are refreshed automatically when they are about to expire, and in the background for tokens from shared_token.
         username: The username that the token belongs to.
         auths: If request if True, all stored tokens matching the specified scope
         url: The url to enter into a browser if the returnUrl paramter is set to True
@@ -163,14 +154,14 @@ class token:
             if not x in valid_scopes:
                 raise ScopeError
         if request:
-            auths = self.load_json(auth_filename)
+            auths = self.load_json(auth_file())
             current_auths = self.find_scope(auths, scope)
             self.auths = current_auths
         else:
             self.scope = scope
-            self.auth_file = auth_filename
+            self.init_expiry()
+            self.auth_file = auth_file()
             self.auth = None
-            self.token = None
             self.refresh = None
             self.auths = self.load_json(self.auth_file)
             self.username = username
@@ -183,6 +174,7 @@ class token:
                 self.auth = self.browser_auth()
                 if self.auth: # stop browser_auth returns None
                     tokens = self.get_token(self.auth)
+                    self.expires_at = oauth.stamp_expiry(tokens)
                     self.token = tokens['access_token']
                     self.refresh = tokens['refresh_token']
                     token_username = self.token_username(self.token)
@@ -192,13 +184,14 @@ class token:
                         if token_username != self.username:
                             raise UsernameError(token_username, self.username)
                     tokens['username']=self.username
-                    self.auths.append(tokens)
-                    self.save_json(self.auth_file, self.auths)
+                    self.auths = oauth.update_saved(self.auth_file, lambda auths: auths + [tokens])
             else:
                 tokens = cacheAuth
                 self.token = tokens['access_token']
                 self.refresh = tokens['refresh_token']
-                self.refresh_token()
+                self.expires_at = tokens.get('expires_at', 0)
+                if not self.valid(): # A saved token with time left is used as it is, rather than refreshed
+                    self.refresh_token()
 
     def load_json(self, auth_file):
         f = open(auth_file,"r")
@@ -210,17 +203,12 @@ class token:
         headers = {
 	        'authorization': 'Bearer '+testToken
         }
-        r = requests.get("https://api.spotify.com/v1/me",headers=headers)
+        r = connection.get("https://api.spotify.com/v1/me",headers=headers)
         if r.status_code != 200:
             raise ApiError(r.status_code, 200, r.text)
         data = json.loads(r.text)
         return data['id']
     
-    def save_json(self, auth_file, data):
-        f=open(auth_file,"w")
-        f.write(json.dumps(data))
-        f.close()
-
     def sort_scope(self, scope):
         scopeList = scope.split(" ")
         scopeList.sort()
@@ -252,6 +240,7 @@ class token:
             return None
     
     def browser_auth(self):
+        client_id, client_secret = config.settings.credentials("spotify")
         if self.returnUrl == False:
             url = "https://accounts.spotify.com/authorize/?client_id="+client_id+"&response_type=code&redirect_uri="+quote(redirect_uri)+"&scope="+quote(self.scope)
             print("Use this URL in your browser to log in to Spotify")
@@ -272,6 +261,7 @@ class token:
             raise TypeError("Invalid parameter for returnUrl")
 
     def get_token(self, auth_code):
+        client_id, client_secret = config.settings.credentials("spotify")
         data = {
             'grant_type':'authorization_code',
             'code':auth_code,
@@ -283,18 +273,12 @@ class token:
             'accept':'application/json',
             'content-type':'application/x-www-form-urlencoded'
             }
-        r = requests.post("https://accounts.spotify.com/api/token",data=data,headers=headers)
+        r = connection.post("https://accounts.spotify.com/api/token",data=data,headers=headers)
         if r.status_code != 200:
             raise ApiError(r.status_code, 200, r.text)
         tokens = json.loads(r.text)
         return tokens
 
-    def pop_token(self, auths, token):
-        for index in range(0,len(auths)-1):
-            if auths[index]['access_token']==token:
-                auths.pop(index)
-        return auths
-    
     def refresh_token(self):
         """
         Refreshes the access token using the refresh token.
@@ -302,6 +286,7 @@ class token:
         Raises:
             ApiError: The API errored in some way. The returned error will be displayed if it exists.
         """
+        client_id, client_secret = config.settings.credentials("spotify")
         refresh_token = self.refresh
         data = {
             'grant_type':'refresh_token',
@@ -314,16 +299,15 @@ class token:
             'accept':'application/json',
             'content-type':'application/x-www-form-urlencoded'
             }
-        r = requests.post("https://accounts.spotify.com/api/token",headers=headers,data=data)
+        r = connection.post("https://accounts.spotify.com/api/token",headers=headers,data=data)
         if r.status_code != 200:
             raise ApiError(r.status_code, 200, r.text)
-        self.auths = self.pop_token(self.auths, self.token)
         tokens = json.loads(r.text)
+        self.expires_at = oauth.stamp_expiry(tokens)
         self.token = tokens["access_token"]
         tokens['username']=self.username
         tokens['refresh_token']=self.refresh
-        self.auths.append(tokens)
-        self.save_json(self.auth_file, self.auths)
+        self.auths = oauth.replace_saved(self.auth_file, tokens)
         self.token = tokens['access_token']
         return tokens
 
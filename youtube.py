@@ -1,20 +1,13 @@
-import requests, json, os
+import connection, config, oauth, json
 from urllib.parse import quote, unquote
 
-creds_file = "api_creds.json"
-with open(creds_file) as f:
-    data = json.loads(f.read())
-    client_id = data['youtube']['client_id']
-    client_secret = data['youtube']['client_secret']
-
+# Client credentials are read by the config module the first time they are needed, from api_creds.json or the environment
 redirect_uri = "https://localhost/"
 auth_filename = "data/youtube_auth.json"
 
-head, tail = os.path.split(auth_filename)
-if head and not os.path.isdir(head): os.makedirs(head)
-if not os.path.isfile(auth_filename):
-    with open(auth_filename, "w") as f:
-        f.write("[]")
+# Returns auth_filename, creating it with no saved tokens the first time it's needed
+def auth_file():
+    return config.ensure_file(auth_filename, "[]")
 
 # All valid Google scopes that pertain to YouTube
 valid_scopes = [
@@ -76,31 +69,43 @@ class ApiError(Error):
         else:
             Exception.__init__(self, "Response <" + str(expectedCode) + "> expected, <" + str(statusCode) + "> recived\nContent - " + err)
 
+class QuotaError(Error):
+    """
+    Raised when a request, or a job about to start, needs more YouTube Data API quota than is left in today's budget
+
+    Args:
+        needed: The quota units that were needed
+        remaining: The quota units left today
+    """
+    def __init__(self, needed, remaining):
+        self.needed = needed
+        self.remaining = remaining
+        Exception.__init__(self, "Not enough YouTube quota left today - " + str(needed) + " units needed, " + str(remaining) + " remaining")
+
 def wipe_cache():
     """
     Wipes auth.json, deleting any cached tokens. The user will need to log in again when creating a new token.
     """
-    f = open(auth_filename,"w")
-    f.write("[]")
-    f.close()
+    oauth.forget("youtube")
+    oauth.update_saved(auth_file(), lambda tokens: [])
 
 def delete_account(username):
     """
     Deletes all cached tokens with the specified username
     """
+    oauth.forget("youtube", username)
     print("Deleting " + username)
-    f = open(auth_filename, "r")
-    tokens = json.loads(f.read())
-    f.close()
-    for i, token in enumerate(tokens):
-        if token['username'] == username:
-            tokens.pop(i)
-    f = open(auth_filename, "w")
-    f.write(json.dumps(tokens))
-    f.close()
+    oauth.update_saved(auth_file(), lambda tokens: [token for token in tokens if token['username'] != username])
 
 
-class token:
+def shared_token(scope, username):
+    """
+    Returns the token object for a saved account, creating it the first time. Every caller asking for the same scope
+    and username gets the same object, so the access token is only refreshed once for all of them.
+    """
+    return oauth.shared_token("youtube", token, scope, username)
+
+class token(oauth.ExpiringToken):
     """
         An class that handles the YouTube Data API authentication process, including user login and token refreshing.
 
@@ -113,8 +118,9 @@ class token:
 
         Attributes:
             scope: The all scopes of the token, as a string sperated by spaces
-            token: The access token that the user logged in with.
-            refresh: The refresh token. YouTube Web API tokens expire after an hour. Use the refresh_token function rather than manually refreshing the token.
+            token: The access token that the user logged in with. Refreshed first if it is about to expire.
+            expires_at: The unix time that the access token expires at.
+            refresh: The refresh token. YouTube Web API tokens expire after an hour. They are refreshed automatically when they are about to expire, and in the background for tokens from shared_token.
             username: The username that the token belongs to.
             auths: If request if True, all stored tokens matching the specified scope
             url: The url to enter into a browser if the returnUrl paramter is set to True
@@ -142,16 +148,16 @@ class token:
         if request:
             if username != None:
                 raise Warning("Request Mode - username parameter is ignored")
-            auths = self.load_json(auth_filename)
+            auths = self.load_json(auth_file())
             current_auths = self.find_scope(auths, newScope)
             self.auths = current_auths
         else:
             self.scope = newScope[:-1]
-            self.auth_file = auth_filename
+            self.init_expiry()
+            self.auth_file = auth_file()
             self.auth = None
-            self.token = None
             self.refresh = None
-            self.auths = self.load_json(auth_filename)
+            self.auths = self.load_json(auth_file())
             self.username = username
             self.returnUrl = returnUrl
             if returnUrl == False:
@@ -162,6 +168,7 @@ class token:
                 self.auth = self.browser_auth(self.username)
                 if self.auth:
                     tokens = self.get_token(self.auth)
+                    self.expires_at = oauth.stamp_expiry(tokens)
                     self.token = tokens['access_token']
                     self.refresh = tokens['refresh_token']
                     token_username = self.token_username(self.token) # uses email as unique username
@@ -172,13 +179,14 @@ class token:
                             raise UsernameError(token_username, self.username)
                     tokens['username']=self.username
                     tokens['scope']=self.scope
-                    self.auths.append(tokens)
-                    self.save_json(self.auths)
+                    self.auths = oauth.update_saved(self.auth_file, lambda auths: auths + [tokens])
             else:
                 tokens = cacheAuth
                 self.token = tokens['access_token']
                 self.refresh = tokens['refresh_token']
-                self.refresh_token()
+                self.expires_at = tokens.get('expires_at', 0)
+                if not self.valid(): # A saved token with time left is used as it is, rather than refreshed
+                    self.refresh_token()
 
     def load_json(self, auth_filename):
         f = open(auth_filename,"r")
@@ -190,7 +198,7 @@ class token:
         headers = {
             "authorization": "Bearer " + testToken
         }
-        r = requests.get("https://www.googleapis.com/plus/v1/people/me", headers=headers)
+        r = connection.get("https://www.googleapis.com/plus/v1/people/me", headers=headers)
         if r.status_code != 200:
             raise ApiError(r.status_code, 200, r.text)
         data = json.loads(r.text)
@@ -202,11 +210,6 @@ class token:
             raise Error("This account appears to not have an account email linked")
         return email
 
-    def save_json(self, data):
-        f=open(self.auth_file,"w")
-        f.write(json.dumps(data))
-        f.close()
-
     def sort_scope(self, scope):
         scopeList = scope.split(" ")
         scopeList.sort()
@@ -238,6 +241,7 @@ class token:
             return None
 
     def browser_auth(self, username=None):
+        client_id, client_secret = config.settings.credentials("youtube")
         if self.returnUrl == False:
             url = "https://accounts.google.com/o/oauth2/v2/auth?scope=" + quote(self.scope) + "&response_type=code&redirect_uri=" + quote(redirect_uri) + "&client_id=" + client_id + "&access_type=offline&prompt=consent"
             print("Use this URL in your browser to log in to YouTube")
@@ -258,6 +262,7 @@ class token:
             raise TypeError("Invalid parameter for returnUrl")
 
     def get_token(self, auth_code):
+        client_id, client_secret = config.settings.credentials("youtube")
         data = {
             'grant_type':'authorization_code',
             'code':auth_code,
@@ -269,19 +274,12 @@ class token:
             'accept':'application/json',
             'content-type':'application/x-www-form-urlencoded'
             }
-        r = requests.post("https://www.googleapis.com/oauth2/v4/token",data=data,headers=headers)
+        r = connection.post("https://www.googleapis.com/oauth2/v4/token",data=data,headers=headers)
         if r.status_code != 200:
             raise ApiError(r.status_code, 200, r.text)
         tokens = json.loads(r.text)
         return tokens
 
-    def pop_token(self, auths, token):
-        for index in range(0,len(auths)-1):
-            if auths[index]['access_token']==token:
-                auths.pop(index)
-        return auths
-
-    # Beats me why the code doubles up tokens. It works, I'm not fixing it
     def refresh_token(self):
         """
         Refreshes the access token using the refresh token.
@@ -289,6 +287,7 @@ class token:
         Raises:
             ApiError: The API errored in some way. The returned error will be displayed if it exists.
         """
+        client_id, client_secret = config.settings.credentials("youtube")
         refresh_token = self.refresh
         data = {
             'grant_type':'refresh_token',
@@ -300,17 +299,16 @@ class token:
             'accept':'application/json',
             'content-type':'application/x-www-form-urlencoded'
             }
-        r = requests.post("https://www.googleapis.com/oauth2/v4/token",headers=headers,data=data)
+        r = connection.post("https://www.googleapis.com/oauth2/v4/token",headers=headers,data=data)
         if r.status_code != 200:
             raise ApiError(r.status_code, 200, r.text)
-        self.auths = self.pop_token(self.auths, self.token)
         tokens = json.loads(r.text)
+        self.expires_at = oauth.stamp_expiry(tokens)
         self.token = tokens["access_token"]
         tokens['username']=self.username
         tokens['scope'] = self.scope
         tokens['refresh_token']=self.refresh
-        self.auths.append(tokens)
-        self.save_json(self.auths)
+        self.auths = oauth.replace_saved(self.auth_file, tokens)
         self.token = tokens['access_token']
         return tokens
 